@@ -0,0 +1,118 @@
+# Copyright (C) 2020 RADTorch and Mohamed Elbanan, MD
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see https://www.gnu.org/licenses/
+
+from radtorch.settings import *
+from radtorch.general import *
+from radtorch.dicom import *
+from radtorch.core import *
+
+
+def time_function(function, repeats=10, *args, **kwargs):
+    times=[]
+    for i in range(repeats):
+        start=time.perf_counter()
+        function(*args, **kwargs)
+        times.append(time.perf_counter()-start)
+    return np.median(times)
+
+
+def benchmark_windowing(filepath=None, level=40, width=400, repeats=100, shape=(512,512)):
+    '''
+    Compares float64 arithmetic windowing (previous window_dicom path) with LUT windowing on the same stored pixel array.
+    Uses the pixel data of filepath if supplied, otherwise a random 12-bit image of the given shape.
+    '''
+    if filepath:
+        ds=pydicom.read_file(filepath)
+        pixels=ds.pixel_array
+        modality, slope, intercept=rescale_parameters(ds)
+    else:
+        pixels=np.random.randint(0, 4096, size=shape).astype('uint16')
+        slope, intercept=1.0, -1024.0
+
+    def arithmetic(pixels):
+        img_hu = pixels*slope + intercept
+        lower = level - (width / 2)
+        upper = level + (width / 2)
+        img_hu[img_hu<=lower] = lower
+        img_hu[img_hu>=upper] = upper
+        return img_hu
+
+    window_array(pixels, slope, intercept, level, width) # builds and memoizes the LUT.
+    results=[]
+    for name, function in [('arithmetic_float64', lambda: arithmetic(pixels)), ('lut_float32', lambda: window_array(pixels, slope, intercept, level, width, 'float32')), ('lut_uint8', lambda: window_array(pixels, slope, intercept, level, width, 'uint8'))]:
+        results.append({'METHOD':name, 'SHAPE':str(pixels.shape), 'MEDIAN_TIME_US':time_function(function, repeats)*1e6})
+    results=pd.DataFrame(results)
+    results['SPEEDUP']=results['MEDIAN_TIME_US'].iloc[0]/results['MEDIAN_TIME_US']
+    max_error=np.abs(arithmetic(pixels)-window_array(pixels, slope, intercept, level, width, 'float32')).max()
+    log('Windowing benchmark: maximum difference between arithmetic and LUT windowing = '+str(max_error))
+    return results
+
+
+def current_rss():
+    # Resident set size of this process in MB. Falls back to peak RSS where /proc is not available.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/1024**2
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+
+def benchmark_data_processor(num_images=100000, num_classes=2, model_arch='resnet18', type='nn_classifier'):
+    '''
+    Measures Data_Processor construction time and memory on a synthetic table of num_images rows.
+    Files are never opened: construction only splits the table, datasets and dataloaders are created on first access.
+    '''
+    table=pd.DataFrame({'IMAGE_PATH':['image_'+str(i)+'.dcm' for i in range(num_images)], 'IMAGE_LABEL':[str(i%num_classes) for i in range(num_images)]})
+    results=[]
+    rss=current_rss()
+    start=time.perf_counter()
+    data_processor=Data_Processor(table=table, model_arch=model_arch, type=type)
+    results.append({'STEP':'construction', 'TIME_S':time.perf_counter()-start, 'RSS_INCREASE_MB':current_rss()-rss})
+    for split in data_processor.splits.keys():
+        rss=current_rss()
+        start=time.perf_counter()
+        data_processor.get_dataloader(split)
+        results.append({'STEP':split+'_dataloader', 'TIME_S':time.perf_counter()-start, 'RSS_INCREASE_MB':current_rss()-rss})
+    return pd.DataFrame(results)
+
+
+def benchmark_inference_modes(model_arch='resnet50', modes=None, batch_size=32, num_batches=4, dataloader=None, pre_trained=True, device=torch.device('cpu')):
+    '''
+    Compares Feature_Extractor inference modes (INFERENCE_MODES) on the same images: throughput (images/s) and feature deviation from fp32.
+    Uses the first num_batches batches of dataloader if supplied, otherwise random images of the model input size. One warm up batch per mode is not timed.
+    MAX_ABS_DEVIATION is the largest absolute difference to fp32 features, MAX_REL_DEVIATION the same divided by the largest absolute fp32 feature.
+    '''
+    if modes is None: modes=list(INFERENCE_MODES.keys())
+    if dataloader is None:
+        size=model_dict[model_arch]['input_size']
+        batches=[torch.rand(batch_size, 3, size, size) for i in range(num_batches)]
+    else:
+        batches=[imgs for imgs, labels, paths in itertools.islice(dataloader, num_batches)]
+    num_images=sum(len(i) for i in batches)
+    feature_extractor=Feature_Extractor(model_arch=model_arch, pre_trained=pre_trained, unfreeze=False, device=device)
+    results=[]
+    baseline=None
+    for mode in ['fp32']+[i for i in modes if i!='fp32']:
+        feature_extractor.inference=mode
+        feature_extractor._prepare_model()
+        feature_extractor.infer(batches[0])
+        start=time.perf_counter()
+        features=torch.cat([feature_extractor.infer(i).cpu() for i in batches]).numpy()
+        elapsed=time.perf_counter()-start
+        if baseline is None: baseline=features
+        deviation=np.abs(features-baseline).max()
+        results.append({'MODE':mode, 'IMAGES_PER_S':num_images/elapsed, 'MAX_ABS_DEVIATION':deviation, 'MAX_REL_DEVIATION':deviation/max(np.abs(baseline).max(), 1e-12)})
+    results=pd.DataFrame(results)
+    results['SPEEDUP']=results['IMAGES_PER_S']/results['IMAGES_PER_S'].iloc[0]
+    log('Inference benchmark: '+model_arch+', '+str(num_images)+' images, '+str(torch.get_num_threads())+' threads.')
+    return results[results['MODE'].isin(modes)].reset_index(drop=True)
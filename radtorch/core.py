@@ -26,23 +26,49 @@ class RADTorch_Dataset(Dataset):
             if k not in kwargs.keys():
                 setattr(self, k, v)
 
+        if isinstance(self.pixel_cache, str): self.pixel_cache=Pixel_Cache(cache_dir=self.pixel_cache, max_size=self.pixel_cache_size)
+        if self.mode=='MWIN' and (self.wl is None or len(self.wl)!=3): # windows become the image channels fed to PIL and the backbones.
+            raise ValueError('Error! MWIN mode requires exactly 3 combinations of W and L, one per image channel.')
+        if self.read_ahead and self.pixel_cache: self.read_ahead=False # cached images are not read from files.
+        if self.read_ahead and not isinstance(self.read_ahead, Read_Ahead): self.read_ahead=Read_Ahead(depth=32 if self.read_ahead is True else self.read_ahead, num_threads=self.read_ahead_threads)
+
+    @property
+    def input_data(self):
+        return self._input_data
+
+    @input_data.setter
+    def input_data(self, table): #the array index is rebuilt whenever the table is replaced (e.g. balance).
+        self._input_data=table
+        self._data_index=None
+
+    @property
+    def data_index(self):
+        if self._data_index is None: self.build_index()
+        return self._data_index
+
+    def build_index(self): #compiles input_data into arrays so __getitem__ does no pandas work.
+        self._data_index=Dataset_Index(self.input_data, self.image_path_column, self.image_label_column, self.class_to_idx, self.multi_label)
+        return self._data_index
+
     def __getitem__(self, index): #handles how to get an image of the dataset.
-        image_path=self.input_data.iloc[index][self.image_path_column]
+        image_path=self.data_index.path(index)
+        source=self.read_ahead.get(image_path) if self.read_ahead else image_path
         if self.is_dicom:
-            image=dicom_to_narray(image_path, self.mode, self.wl)
+            if self.pixel_cache: image=self.pixel_cache.load(image_path, self.mode, self.wl, self.decode_size)
+            else: image=dicom_to_narray(source, self.mode, self.wl, self.decode_size)
             image=Image.fromarray(image)
         else:
-            image=Image.open(image_path).convert('RGB')
+            image=Image.open(source).convert('RGB')
 
         image=self.transformations(image)
 
-        label=self.input_data.iloc[index][self.image_label_column]
-        label_idx=[v for k, v in self.class_to_idx.items() if k == label][0]
+        if self.multi_label: label_idx=torch.from_numpy(self.data_index.multi_hot[index])
+        else: label_idx=int(self.data_index.labels[index])
 
         return image, label_idx, image_path
 
     def __len__(self): #returns number of images in dataset.
-        return len(self.dataset_files)
+        return len(self.data_index)
 
     def info(self): #returns table of dataset information.
         return show_dataset_info(self)
@@ -63,18 +89,27 @@ class RADTorch_Dataset(Dataset):
         # return over_sample(dataset=self, **kwargs)
         return balance_dataset(dataset=self, **kwargs)
 
-    def mean_std(self): #calculates mean and standard deviation of dataset.
-        self.mean, self.std= calculate_mean_std(torch.utils.data.DataLoader(dataset=self))
-        return tuple(self.mean.tolist()), tuple(self.std.tolist())
+    def balanced_sampler(self, **kwargs): #sampler over the dataset index drawing all classes equally, takes num_samples, upsample, random_state. Use instead of balance() to avoid copying rows.
+        if self.multi_label:
+            raise TypeError('Error! Balanced sampling is not supported for multi label datasets.')
+        return balanced_sampler(labels=self.data_index.labels, **kwargs)
+
+    def mean_std(self, **kwargs): #calculates mean and standard deviation of dataset, takes batch_size, num_workers, sample, confidence, cache, cache_file.
+        result=dataset_mean_std(dataset=self, **kwargs)
+        self.mean, self.std=torch.tensor(result['mean']), torch.tensor(result['std'])
+        return result['mean'], result['std']
 
     def normalize(self, **kwargs): #retruns a normalized dataset with either mean/std of the dataset or a user specified mean/std
         if 'mean' in kwargs.keys() and 'std' in kwargs.keys():
             mean=kwargs['mean']
             std=kwargs['std']
         else:
-            mean, std=self.mean_std()
-        normalized_dataset=copy.deepcopy(self)
-        normalized_dataset.transformations.transforms.append(transforms.Normalize(mean=mean, std=std))
+            mean, std=self.mean_std(**kwargs)
+        normalized_dataset=copy.copy(self)
+        if getattr(self, 'batch_transform', None) is not None: # mean/std are of the current batch_transform output, so the float normalization is chained after it.
+            normalized_dataset.batch_transform=transforms.Compose([self.batch_transform, Batch_Normalize(mean=mean, std=std, scale=1.0)])
+        else:
+            normalized_dataset.transformations=transforms.Compose(self.transformations.transforms+[transforms.Normalize(mean=mean, std=std)])
         return normalized_dataset
 
 
@@ -90,18 +125,8 @@ class Dataset_from_table(RADTorch_Dataset):
         if self.is_dicom: self.dataset_files=[x for x in (self.input_data[self.image_path_column].tolist()) if x.endswith('.dcm')]
         else: self.dataset_files=[x for x in (self.input_data[self.image_path_column].tolist()) if x.endswith(IMG_EXTENSIONS)]
         if self.multi_label == True:
-            self.classes=list(np.unique([item for t in self.input_data[self.image_label_column].to_numpy() for item in t]))
-            self.class_to_idx=class_to_idx(self.classes)
-            self.multi_label_idx=[]
-            for i, row in self.input_data.iterrows():
-                t=[]
-                for u in self.classes:
-                    if u in row[self.image_label_column]:
-                        t.append(1)
-                    else:
-                        t.append(0)
-                self.multi_label_idx.append(t)
-            self.input_data['MULTI_LABEL_IDX']=self.multi_label_idx
+            self.classes=list(np.unique(self.input_data[self.image_label_column].explode().dropna().to_numpy()))
+            self.class_to_idx=class_to_idx(self.classes) # multi-hot labels are encoded in the dataset index, see multi_hot_encode.
         else:
             self.classes= list(self.input_data[self.image_label_column].unique())
             self.class_to_idx=class_to_idx(self.classes)
@@ -110,13 +135,16 @@ class Dataset_from_table(RADTorch_Dataset):
 
         if len(self.classes)    ==0:
             print ('Error! No classes extracted from directory:', self.data_directory)
+        self.build_index()
 
 
 class Dataset_from_folder(RADTorch_Dataset):
     def __init__(self, **kwargs):
         super(Dataset_from_folder, self).__init__(**kwargs)
         self.classes, self.class_to_idx=root_to_class(self.data_directory)
-        self.all_files=list_of_files(self.data_directory)
+        if self.catalog is not None: self.all_files=load_dicom_catalog(self.catalog)['IMAGE_PATH'].tolist()
+        elif self.is_dicom: self.all_files=list_of_files(self.data_directory, extensions=('.dcm',))
+        else: self.all_files=list_of_files(self.data_directory, extensions=IMG_EXTENSIONS)
         if self.is_dicom: self.dataset_files=[x for x in self.all_files  if x.endswith('.dcm')]
         else: self.dataset_files=[x for x in self.all_files if x.endswith(IMG_EXTENSIONS)]
         self.all_classes=[path_to_class(i) for i in self.dataset_files]
@@ -125,11 +153,92 @@ class Dataset_from_folder(RADTorch_Dataset):
             print ('Error! No data files found in directory:', self.data_directory)
         if len(self.classes)==0:
             print ('Error! No classes extracted from directory:', self.data_directory)
+        self.build_index()
+
+
+class Dataset_from_shards(RADTorch_Dataset):
+    '''
+    Reads images exported with export_dataset_shards or Data_Processor.export_shards. Shards are memory-mapped and each image is a view into its shard.
+    transformations are applied to the stored (rows, columns, channels) arrays, default is transforms.ToTensor().
+    Shards of a deferred normalize dataset keep its batch_transform, images are then returned as uint8 tensors (array_to_tensor) for it.
+    kwargs: shard_directory, transformations
+    '''
+    def __init__(self, **kwargs):
+        super(Dataset_from_shards, self).__init__(**kwargs)
+        with open(os.path.join(self.shard_directory, 'shards.pkl'), 'rb') as f:
+            meta=pickle.load(f)
+        for k, v in meta.items():
+            if k not in kwargs.keys():
+                setattr(self, k, v)
+        if 'transformations' not in kwargs.keys(): self.transformations=transforms.Lambda(array_to_tensor) if getattr(self, 'batch_transform', None) is not None else transforms.ToTensor()
+        self.input_data=pd.read_csv(os.path.join(self.shard_directory, 'index.csv'))
+        self.dataset_files=self.input_data[self.image_path_column].tolist()
+        self.shard_index=self.input_data[['SHARD', 'OFFSET', 'LABEL_IDX']].to_numpy()
+        self.shards={}
+        self.build_index()
+
+    def __getitem__(self, index):
+        shard_id, offset, label_idx=self.shard_index[index]
+        if shard_id not in self.shards:
+            self.shards[shard_id]=np.load(os.path.join(self.shard_directory, 'shard_'+str(shard_id).zfill(5)+'.npy'), mmap_mode='c')
+        image=self.transformations(self.shards[shard_id][offset])
+        return image, int(label_idx), self.data_index.path(index)
+
+    def __getstate__(self): # memory maps are re-opened in each DataLoader worker instead of being pickled.
+        state=self.__dict__.copy()
+        state['shards']={}
+        return state
+
+
+class Volume_Dataset(RADTorch_Dataset):
+    '''
+    Dataset of DICOM series for study level classification. Each row of table is one series (folder of DICOM slices) and its label.
+    Each series is assembled once into an int16 memory-mapped volume in volume_directory (see dicom_series_to_volume) and returned as a float tensor (slices, channels, resize, resize).
+    Slices are windowed (mode WIN/MWIN), scaled to [0, 1] like the 2D datasets' ToTensor output, resized and normalized per chunk of slices on tensors.
+    RAW and HU volumes are scaled to [0, 1] with the volume's minimum and maximum. MWIN needs 3 windows, one per backbone input channel.
+    Use with batch_size=1, e.g. with Feature_Extractor.run_volumes.
+    kwargs: table, volume_directory, mode, wl, resize, normalize, image_path_column, image_label_column, num_workers
+    '''
+    def __init__(self, **kwargs):
+        super(Volume_Dataset, self).__init__(**kwargs)
+        if 'resize' not in kwargs.keys(): self.resize=224
+        if isinstance(self.table, str): self.table=pd.read_csv(self.table)
+        self.input_data=self.table
+        self.dataset_files=self.input_data[self.image_path_column].tolist()
+        self.classes=list(self.input_data[self.image_label_column].unique())
+        self.class_to_idx=class_to_idx(self.classes)
+        os.makedirs(self.volume_directory, exist_ok=True)
+        self.build_index()
+
+    def volume(self, index): #int16 memory-mapped volume of series number index, assembled on first use.
+        series_path=self.data_index.path(index)
+        volume_path=os.path.join(self.volume_directory, hashlib.sha1(series_path.encode('utf-8')).hexdigest()+'.npy')
+        if os.path.exists(volume_path): return np.load(volume_path, mmap_mode='r')
+        return dicom_series_to_volume(list_of_files(series_path, extensions=('.dcm',)), volume_path, num_workers=max(self.num_workers, 1))
+
+    def __getitem__(self, index):
+        volume=self.volume(index)
+        if self.mode not in ['WIN', 'MWIN']:
+            lower, upper=float(volume.min()), float(volume.max())
+        slices=[]
+        for start in range(0, len(volume), 32): # chunks of 32 slices bound the float32 memory used for windowing/resizing.
+            chunk=np.ascontiguousarray(volume[start:start+32])
+            if self.mode in ['WIN', 'MWIN']:
+                chunk=np.stack([window_array(chunk, 1.0, 0.0, level, width, 'uint8') for level, width in self.wl], axis=1).astype('float32')/255
+            else:
+                chunk=(chunk[:, np.newaxis].astype('float32')-lower)/max(upper-lower, 1.0)
+            chunk=F.interpolate(torch.from_numpy(chunk), size=(self.resize, self.resize), mode='bilinear', align_corners=False)
+            if chunk.shape[1]==1: chunk=chunk.repeat(1, 3, 1, 1)
+            if isinstance(self.normalize, tuple):
+                mean, std=self.normalize
+                chunk=(chunk-torch.tensor(mean).view(1, -1, 1, 1))/torch.tensor(std).view(1, -1, 1, 1)
+            slices.append(chunk)
+        return torch.cat(slices), int(self.data_index.labels[index]), self.data_index.path(index)
 
 
 class Data_Processor():
     '''
-    kwargs: device, table, data_directory, is_dicom, mode, wl, normalize, balance_class, batch_size, num_workers, model_arch , custom_resize,
+    kwargs: device, table, data_directory, is_dicom, mode, wl, normalize, balance_class, balance_epoch_size, batch_size, num_workers, model_arch , custom_resize, pixel_cache, pixel_cache_size, catalog, deferred_normalize, decode_size, read_ahead, read_ahead_threads
     '''
     def __init__(self, DEFAULT_SETTINGS=DEFAULT_DATASET_SETTINGS, **kwargs):
         for k, v in kwargs.items():
@@ -139,6 +248,9 @@ class Data_Processor():
                 setattr(self, k, v)
         if 'device' not in kwargs.keys(): self.device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+        # Decoded pixel cache shared by all datasets created by this processor
+        if isinstance(self.pixel_cache, str): self.pixel_cache=Pixel_Cache(cache_dir=self.pixel_cache, max_size=self.pixel_cache_size)
+
         # Create Initial Master Table
         if isinstance(self.table, str):
                 if self.table!='':
@@ -146,21 +258,27 @@ class Data_Processor():
         elif isinstance(self.table, pd.DataFrame): self.table=self.table
         else:
             classes, class_to_idx=root_to_class(self.data_directory)
-            all_files=list_of_files(self.data_directory)
+            if self.catalog is not None: all_files=load_dicom_catalog(self.catalog)['IMAGE_PATH'].tolist()
+            elif self.is_dicom: all_files=list_of_files(self.data_directory, extensions=('.dcm',))
+            else: all_files=list_of_files(self.data_directory, extensions=IMG_EXTENSIONS)
             if self.is_dicom: dataset_files=[x for x in all_files  if x.endswith('.dcm')]
             else: dataset_files=[x for x in all_files if x.endswith(IMG_EXTENSIONS)]
             all_classes=[path_to_class(i) for i in dataset_files]
             self.table=pd.DataFrame(list(zip(dataset_files, all_classes)), columns=[self.image_path_column, self.image_label_column])
 
 
-        # Split into test, valid and train
-        self.temp_table, self.test_table=train_test_split(self.table, test_size=self.test_percent, random_state=100, shuffle=True)
-        self.train_table, self.valid_table=train_test_split(self.temp_table, test_size=(len(self.table)*self.valid_percent/len(self.temp_table)), random_state=100, shuffle=True)
+        # Split into test, valid and train. Splits are integer positions over self.table, tables and datasets are created on first use.
+        positions=np.arange(len(self.table))
+        self.temp_idx, self.test_idx=train_test_split(positions, test_size=self.test_percent, random_state=100, shuffle=True)
+        self.train_idx, self.valid_idx=train_test_split(self.temp_idx, test_size=(len(self.table)*self.valid_percent/len(self.temp_idx)), random_state=100, shuffle=True)
+        if self.type=='nn_classifier': self.splits={'train':self.train_idx, 'valid':self.valid_idx, 'test':self.test_idx}
+        else: self.splits={'train':self.temp_idx, 'test':self.test_idx}
 
         # Define Transformations
         # 1- Custom Resize Adjustement
         if self.custom_resize in [False, '', 0, None]: self.resize=model_dict[self.model_arch]['input_size']
         elif isinstance(self.custom_resize, int): self.resize=self.custom_resize
+        if self.decode_size==True: self.decode_size=self.resize # DICOM images are decoded/downsampled close to the resize target.
 
         # 2- Image conversion from DICOM
         if 'transformations' not in self.__dict__.keys():
@@ -177,7 +295,7 @@ class Data_Processor():
 
 
         # 3- Normalize Training Dataset
-        self.train_transformations=copy.deepcopy(self.transformations)
+        self.train_transformations=transforms.Compose(list(self.transformations.transforms))
         if 'extra_transformations' in self.__dict__.keys():
             for i in self.extra_transformations:
                 self.train_transformations.transforms.insert(1, i)
@@ -190,34 +308,94 @@ class Data_Processor():
             log('Error! Selected mean and standard deviation are not allowed.')
             pass
 
-        self.dataset_kwargs=copy.deepcopy(self.__dict__)
-        del self.dataset_kwargs['table']
-
-        self.train_dataset_kwargs=copy.deepcopy(self.dataset_kwargs)
-        # del self.train_dataset_kwargs['transformations']
+        self.dataset_kwargs={k:v for k, v in self.__dict__.items() if k not in ['table', 'temp_idx', 'train_idx', 'valid_idx', 'test_idx', 'splits']}
+        self.train_dataset_kwargs=dict(self.dataset_kwargs)
         self.train_dataset_kwargs['transformations']=self.train_transformations
 
-        self.master_dataset=Dataset_from_table(table=self.table, **self.dataset_kwargs)
-        self.master_dataloader=torch.utils.data.DataLoader(dataset=self.master_dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
-        self.num_output_classes=len(self.master_dataset.classes)
+        # 4- Workers return uint8 images, conversion to float and normalization are done per batch in the main process
+        if self.deferred_normalize:
+            self.dataset_kwargs['transformations'], self.dataset_kwargs['batch_transform']=defer_tensor_transformations(self.transformations)
+            self.train_dataset_kwargs['transformations'], self.train_dataset_kwargs['batch_transform']=defer_tensor_transformations(self.train_transformations)
+
+        if self.multi_label: self.num_output_classes=self.table[self.image_label_column].explode().nunique()
+        else: self.num_output_classes=self.table[self.image_label_column].nunique()
+        self.datasets={}
+        self.dataloaders={}
+
+    def get_dataset(self, split): #split: 'master', 'train', 'valid' or 'test'. Datasets are created on first use.
+        if split not in self.datasets:
+            if split=='master':
+                self.datasets[split]=Dataset_from_table(table=self.table, **self.dataset_kwargs)
+            elif split in self.splits:
+                if split=='train':
+                    self.datasets[split]=Dataset_from_table(table=self.table.iloc[self.splits[split]], **self.train_dataset_kwargs)
+                else:
+                    self.datasets[split]=Dataset_from_table(table=self.table.iloc[self.splits[split]], **self.dataset_kwargs)
+            else:
+                raise AttributeError(split+'_dataset')
+        return self.datasets[split]
+
+    def get_dataloader(self, split):
+        if split not in self.dataloaders:
+            dataset=self.get_dataset(split)
+            if split=='train' and self.balance_class: # classes are balanced by sampling, epoch size set by balance_epoch_size.
+                sampler=dataset.balanced_sampler(num_samples=self.balance_epoch_size, upsample=True, random_state=100)
+                self.dataloaders[split]=create_dataloader(dataset=dataset, batch_size=self.batch_size, sampler=sampler, num_workers=self.num_workers)
+            else:
+                self.dataloaders[split]=create_dataloader(dataset=dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
+        return self.dataloaders[split]
 
+    def split_dataloader(self, splits=None): #one loader over several splits (default all) visited in one pass in master table order, see Split_Loader.
+        if splits is None: splits=list(self.splits.keys())
+        datasets={split:self.get_dataset(split) for split in splits}
+        order=[]
+        offset=0
+        for split in splits:
+            if split=='train' and self.balance_class:
+                sampler=self.get_dataloader(split).sampler
+                if isinstance(sampler, Read_Ahead_Sampler): sampler=sampler.sampler # drawing from Read_Ahead_Sampler would plan and start reading its own order.
+                split_order=np.array(list(sampler), dtype='int64') # balanced sample, with repeats.
+            else: split_order=np.arange(len(datasets[split]))
+            split_order=split_order[np.argsort(self.splits[split][split_order], kind='stable')]
+            order+=(split_order+offset).tolist()
+            offset+=len(datasets[split])
+        return Split_Loader(datasets, order, batch_size=self.batch_size, num_workers=self.num_workers)
 
-        if self.type=='nn_classifier':
-            self.train_dataset=Dataset_from_table(table=self.train_table, **self.train_dataset_kwargs)
-            if self.balance_class:
-                self.train_dataset=self.train_dataset.balance(label_col=self.image_label_column, upsample=True)
-            self.valid_dataset=Dataset_from_table(table=self.valid_table, **self.dataset_kwargs)
-            self.train_dataloader=torch.utils.data.DataLoader(dataset=self.train_dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
-            self.valid_dataloader=torch.utils.data.DataLoader(dataset=self.valid_dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
+    @property
+    def master_dataset(self): return self.get_dataset('master')
 
-        else:
-            self.train_dataset=Dataset_from_table(table=self.temp_table,  **self.train_dataset_kwargs)
-            if self.balance_class:
-                self.train_dataset=self.train_dataset.balance(label_col=self.image_label_column, upsample=True)
-            self.train_dataloader=torch.utils.data.DataLoader(dataset=self.train_dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
+    @property
+    def train_dataset(self): return self.get_dataset('train')
+
+    @property
+    def valid_dataset(self): return self.get_dataset('valid')
+
+    @property
+    def test_dataset(self): return self.get_dataset('test')
+
+    @property
+    def master_dataloader(self): return self.get_dataloader('master')
+
+    @property
+    def train_dataloader(self): return self.get_dataloader('train')
+
+    @property
+    def valid_dataloader(self): return self.get_dataloader('valid')
+
+    @property
+    def test_dataloader(self): return self.get_dataloader('test')
 
-        self.test_dataset=Dataset_from_table(table=self.test_table, **self.dataset_kwargs)
-        self.test_dataloader=torch.utils.data.DataLoader(dataset=self.test_dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
+    @property
+    def temp_table(self): return self.table.iloc[self.temp_idx]
+
+    @property
+    def train_table(self): return self.table.iloc[self.train_idx]
+
+    @property
+    def valid_table(self): return self.table.iloc[self.valid_idx]
+
+    @property
+    def test_table(self): return self.table.iloc[self.test_idx]
 
     def classes(self):
         return self.master_dataset.class_to_idx
@@ -226,9 +404,8 @@ class Data_Processor():
         info=pd.DataFrame.from_dict(({key:str(value) for key, value in self.__dict__.items()}).items())
         info.columns=['Property', 'Value']
         info=info.append({'Property':'master_dataset_size', 'Value':len(self.master_dataset)}, ignore_index=True)
-        for i in ['train_dataset', 'valid_dataset','test_dataset']:
-            if i in self.__dict__.keys():
-                info.append({'Property':i+'_size', 'Value':len(self.__dict__[i])}, ignore_index=True)
+        for i in self.splits.keys():
+            info=info.append({'Property':i+'_dataset_size', 'Value':len(self.splits[i])}, ignore_index=True)
         return info
 
     def dataset_info(self, plot=True, figure_size=(500,300)):
@@ -237,12 +414,12 @@ class Data_Processor():
         info_dict['dataset'].style.set_caption('Dataset')
         if 'type' in self.__dict__.keys():
             for i in ['train_dataset','test_dataset']:
-                if i in self.__dict__.keys():
-                    info_dict[i]= show_dataset_info(self.__dict__[i])
+                if hasattr(self, i):
+                    info_dict[i]= show_dataset_info(getattr(self, i))
                     info_dict[i].style.set_caption(i)
             if self.type=='nn_classifier':
-                if 'valid_dataset' in self.__dict__.keys():
-                    info_dict['valid_dataset']= show_dataset_info(self.__dict__['valid_dataset'])
+                if hasattr(self, 'valid_dataset'):
+                    info_dict['valid_dataset']= show_dataset_info(self.valid_dataset)
                     info_dict[i].style.set_caption('valid_dataset')
 
         if plot:
@@ -254,16 +431,18 @@ class Data_Processor():
     def sample(self, figure_size=(10,10), show_labels=True, show_file_name=False):
         show_dataloader_sample(self.train_dataloader, figure_size=figure_size, show_labels=show_labels, show_file_name=show_file_name)
 
-    def check_leak(self, show_file=False):
-        train_file_list=self.train_dataset.input_data[self.image_path_column]
-        test_file_list=self.test_dataset.input_data[self.image_path_column]
-        leak_files=[]
-        for i in train_file_list:
-            if i in test_file_list:
-                leak_files.append(i)
-        log('Data Leak Check: '+str(len(train_file_list))+' train files checked. '+str(len(leak_files))+' common files were found in train and test datasets.')
+    def check_leak(self, show_file=False, uid=True, pixels=False, num_workers=8, cache_file=None): #checks for images shared between splits by path, DICOM UIDs and optionally pixel content. See find_leaks.
+        leaks=find_leaks({split:self.table.iloc[split_idx] for split, split_idx in self.splits.items()}, image_path_column=self.image_path_column, uid=uid and self.is_dicom, pixels=pixels, num_workers=num_workers, cache_file=cache_file)
+        summary=', '.join([check+': '+str(leaks[leaks['CHECK']==check]['KEY'].nunique()) for check in leaks['CHECK'].unique()])
+        log('Data Leak Check: '+str(len(self.table))+' files checked. '+str(leaks['KEY'].nunique())+' duplicates were found across splits.'+(' ('+summary+')' if summary else ''))
         if show_file:
-            return pd.DataFrame(leak_files, columns='leaked_files')
+            return leaks
+
+    def export_shards(self, output_directory, shard_size=4096):
+        # Exports train/valid/test splits, without augmentation or class balancing, to packed shards readable with Dataset_from_shards.
+        for split, split_idx in self.splits.items():
+            log('Exporting '+split+' dataset to shards.')
+            export_dataset_shards(Dataset_from_table(table=self.table.iloc[split_idx], **self.dataset_kwargs), os.path.join(output_directory, split), shard_size=shard_size, batch_size=self.batch_size, num_workers=self.num_workers)
 
     def export(self, output_path):
         try:
@@ -277,12 +456,13 @@ class Data_Processor():
 
 class Feature_Extractor():
     '''
-    kwargs: model_arch, pre_trained, unfreeze, device, dataloader
+    kwargs: model_arch, pre_trained, unfreeze, device, dataloader, feature_cache, model (optional, backbone to use instead of creating one), inference (one of INFERENCE_MODES, default 'fp32')
     '''
     def __init__(self, **kwargs):
         for k,v in kwargs.items():
             setattr(self,k,v)
-        if self.model_arch not in supported_models:
+        if 'model' in kwargs.keys(): pass # shared backbone, e.g. model of another Feature_Extractor.
+        elif self.model_arch not in supported_models:
             log('Error! Provided model architecture is not yet suported. Please use radtorch.settings.supported_models to see full list of supported models.')
             pass
         elif self.model_arch=='vgg11': self.model=torchvision.models.vgg11(pretrained=self.pre_trained)
@@ -320,28 +500,205 @@ class Feature_Extractor():
     def num_features(self):
         return model_dict[self.model_arch]['output_features']
 
-    def run(self, verbose=False):
+    def run(self, verbose=False, feature_store=None, dtype='float32', checkpoint_every=20):
+        '''
+        Extracts features of all images in dataloader into one preallocated (images x features) matrix, batch by batch.
+        feature_store: directory where the matrix is kept as a memory-mapped features.npy with index.csv (paths, labels) and progress.pkl sidecars.
+        An interrupted run with the same feature_store resumes from the last checkpoint (every checkpoint_every batches), using the saved image order.
+        dtype: 'float32' or 'float16'.
+        With a feature_cache (Feature_Cache or directory, Feature_Extractor kwarg), only images missing from the cache are run through the model, the rest are read from the cache. feature_store is not used then.
+        Results: features_array (NumPy matrix), features (DataFrame over features_array without copy), labels_idx, img_path_list and feature_table.
+        '''
         if 'balance_class' in self.__dict__.keys() and 'normalize' in self.__dict__.keys():
             log('Running Feature Extraction using '+str(self.model_arch)+' architecture with balance_class = '+str(self.balance_class)+' and normalize = '+str(self.normalize)+".")
         else:
             log('Running Feature Extraction using '+str(self.model_arch)+' architecture')
-        self.features=[]
+        dataloader=self._prepare(feature_store, dtype)
+        self._prepare_model()
+        for i, (imgs, labels, paths) in tqdm(enumerate(dataloader), total=len(dataloader)):
+            self._process_batch(imgs, labels, paths)
+            if (i+1)%checkpoint_every==0:
+                if self.cache_keys is not None: self._flush_cache()
+                elif feature_store: self._checkpoint()
+        self._finalize()
+        log('Features extracted successfully.')
+        if verbose:
+            print (self.feature_table)
+
+    def _prepare(self, feature_store, dtype):
+        # Allocates the feature matrix and returns the dataloader of images still to extract.
+        self.feature_names=['f_'+str(i) for i in range(0,self.num_features())]
+        self.feature_store=feature_store
+        self._feature_table=None
         self.labels_idx=[]
         self.img_path_list=[]
+        self.cache_keys=None
+        if 'feature_cache' in self.__dict__.keys() and self.feature_cache:
+            self.feature_store=None
+            return self._prepare_cached(dtype)
+        if not feature_store:
+            self.features_array=np.empty((len(self.dataloader.sampler), self.num_features()), dtype=dtype)
+            self.offset=0
+            return self.dataloader
+        os.makedirs(feature_store, exist_ok=True)
+        progress_path=os.path.join(feature_store, 'progress.pkl')
+        if os.path.exists(progress_path):
+            with open(progress_path, 'rb') as f:
+                self.progress=pickle.load(f)
+            self.features_array=np.load(os.path.join(feature_store, 'features.npy'), mmap_mode='r+')
+            index=pd.read_csv(os.path.join(feature_store, 'index.csv'), dtype=str)
+            if len(index)>self.progress['offset']: # rows appended after the last saved offset are dropped.
+                index=index.iloc[:self.progress['offset']]
+                index.to_csv(os.path.join(feature_store, 'index.csv'), index=False)
+            self.img_path_list, self.labels_idx=index['IMAGE_PATH'].tolist(), [json.loads(i) for i in index['IMAGE_LABEL']]
+            log('Resuming feature extraction from image '+str(self.progress['offset'])+' of '+str(len(self.progress['order']))+'.')
+        else:
+            self.progress={'order':list(self.dataloader.sampler), 'offset':0, 'model_arch':self.model_arch}
+            self.features_array=np.lib.format.open_memmap(os.path.join(feature_store, 'features.npy'), mode='w+', dtype=dtype, shape=(len(self.progress['order']), self.num_features()))
+            pd.DataFrame(columns=['IMAGE_PATH', 'IMAGE_LABEL']).to_csv(os.path.join(feature_store, 'index.csv'), index=False)
+            self.offset=0
+            self._checkpoint()
+        self.offset=self.progress['offset']
+        return loader_subset(self.dataloader, self.progress['order'][self.offset:])
+
+    def _prepare_cached(self, dtype):
+        # Reads paths/labels from the dataset index and returns a dataloader over images missing from the cache, each image once.
+        if isinstance(self.feature_cache, str): self.feature_cache=Feature_Cache(self.feature_cache)
+        dataset=self.dataloader.dataset
+        self.feature_cache.open(self.model, self.model_arch if self.inference_mode()=='fp32' else self.model_arch+'/'+self.inference_mode())
+        order=list(self.dataloader.sampler)
+        self.img_path_list, self.labels_idx=map(list, zip(*[item_path_label(dataset, i) for i in order])) if len(order)>0 else ([], [])
+        signatures={}
+        for i in order:
+            item_dataset=dataset_item(dataset, i)[0]
+            if id(item_dataset) not in signatures: signatures[id(item_dataset)]=self.feature_cache.dataset_signature(item_dataset)
+        self.cache_keys=[self.feature_cache.image_key(path, signatures[id(dataset_item(dataset, i)[0])]) for i, path in zip(order, self.img_path_list)]
+        missing={}
+        for i, key in zip(order, self.cache_keys):
+            if key not in self.feature_cache and key not in missing: missing[key]=i
+        self.missing_keys=list(missing.keys())
+        self.cache_buffer=[]
+        self.cached_offset=0
+        self.offset=0
+        self.features_array=np.empty((len(order), self.num_features()), dtype=dtype)
+        log('Feature cache: '+str(len(set(self.cache_keys))-len(missing))+' images found in cache, '+str(len(missing))+' images to extract.')
+        return loader_subset(self.dataloader, list(missing.values()))
+
+    def _flush_cache(self):
+        if len(self.cache_buffer)>0:
+            self.feature_cache.put(self.missing_keys[self.cached_offset:self.offset], np.concatenate(self.cache_buffer))
+            self.cache_buffer=[]
+            self.cached_offset=self.offset
+
+    def inference_mode(self):
+        mode=getattr(self, 'inference', 'fp32')
+        if mode not in INFERENCE_MODES:
+            log('Error! Inference mode '+str(mode)+' not supported, using fp32. Supported modes: '+', '.join(INFERENCE_MODES.keys()))
+            mode='fp32'
+        return mode
+
+    def _prepare_model(self):
+        # Moves the model to device in eval mode and builds inference_model for the inference mode, self.model itself is not changed.
         self.model=self.model.to(self.device)
-        for i, (imgs, labels, paths) in tqdm(enumerate(self.dataloader), total=len(self.dataloader)):
-            self.labels_idx=self.labels_idx+labels.tolist()
-            self.img_path_list=self.img_path_list+list(paths)
+        self.model.eval()
+        self.inference_settings=settings=INFERENCE_MODES[self.inference_mode()]
+        self.inference_model=self.model
+        if settings['fuse']:
+            try:
+                self.inference_model=fuse_conv_bn(self.model)
+            except Exception as e:
+                log('Warning! Convolution/BatchNorm fusion failed, running unfused model: '+repr(e))
+        if settings['channels_last']:
+            if self.inference_model is self.model: self.inference_model=copy.deepcopy(self.model)
+            self.inference_model=self.inference_model.to(memory_format=torch.channels_last)
+
+    def infer(self, imgs): #features of one batch of images with the model prepared by _prepare_model.
+        settings=self.inference_settings
+        if not any(settings.values()):
             with torch.no_grad():
-                self.model.eval()
-                imgs=imgs.to(self.device)
-                output=(self.model(imgs)).tolist()
-                self.features=self.features+(output)
-        # self.feature_names=['f_'+str(i) for i in range(0,(model_dict[self.model_arch]['output_features']))]
+                return self.model(imgs.to(self.device))
+        imgs=imgs.to(self.device, memory_format=torch.channels_last) if settings['channels_last'] else imgs.to(self.device)
+        with torch.inference_mode(), torch.autocast(device_type=torch.device(self.device).type, dtype=torch.bfloat16, enabled=settings['bf16']):
+            return self.inference_model(imgs).float()
+
+    def _process_batch(self, imgs, labels, paths):
+        output=self.infer(imgs)
+        if self.cache_keys is not None:
+            self.cache_buffer.append(output.cpu().numpy())
+            self.offset+=len(output)
+            return
+        self.features_array[self.offset:self.offset+len(output)]=output.cpu().numpy()
+        self.offset+=len(output)
+        self.labels_idx.extend(labels.tolist())
+        self.img_path_list.extend(paths)
+
+    def _checkpoint(self):
+        # Flushes features, appends new index rows and records the offset reached. Written in this order, so a saved offset always has its features and index rows.
+        self.features_array.flush()
+        saved=self.progress['offset']
+        pd.DataFrame({'IMAGE_PATH':self.img_path_list[saved:self.offset], 'IMAGE_LABEL':[json.dumps(i) for i in self.labels_idx[saved:self.offset]]}).to_csv(os.path.join(self.feature_store, 'index.csv'), mode='a', header=False, index=False)
+        self.progress['offset']=self.offset
+        progress_path=os.path.join(self.feature_store, 'progress.pkl')
+        with open(progress_path+'.tmp', 'wb') as f:
+            pickle.dump(self.progress, f)
+        os.replace(progress_path+'.tmp', progress_path)
+
+    def _finalize(self):
+        if self.cache_keys is not None:
+            self._flush_cache()
+            self.feature_cache.get(self.cache_keys, out=self.features_array)
+        elif self.feature_store:
+            self._checkpoint()
+            self.features_array=np.load(os.path.join(self.feature_store, 'features.npy'), mmap_mode='r')
+        self.features=pd.DataFrame(self.features_array, columns=self.feature_names, copy=False)
+        self.split_list=getattr(self.dataloader, 'split_list', None)
+        self.inference_model=None
+
+    def split_features(self, split): #features, labels, feature names and paths of one split after running on a Split_Loader, in extracted_feature_dictionary format.
+        rows=np.flatnonzero(np.array(self.split_list)==split)
+        if len(rows)>0 and rows[-1]-rows[0]+1==len(rows): rows=slice(rows[0], rows[-1]+1) # contiguous split, features are a view.
+        return {'features':self.features.iloc[rows], 'labels':np.array(self.labels_idx, dtype=object)[rows].tolist(), 'features_names':self.feature_names, 'paths':np.array(self.img_path_list, dtype=object)[rows].tolist()}
+
+    @property
+    def feature_table(self): #image paths, labels and features in one table, built on first use.
+        if getattr(self, '_feature_table', None) is None:
+            feature_table=pd.DataFrame({'IMAGE_PATH':self.img_path_list, 'IMAGE_LABEL':self.labels_idx})
+            self._feature_table=pd.concat([feature_table, self.features], axis=1)
+        return self._feature_table
+
+    @feature_table.setter
+    def feature_table(self, table):
+        self._feature_table=table
+
+    def run_volumes(self, dataloader=None, slice_batch_size=64, pooling='mean', verbose=False):
+        '''
+        Extracts one feature vector per series from a Volume_Dataset dataloader (batch_size=1).
+        Slices of each volume go through the model in batches of slice_batch_size and are pooled into study level features.
+        pooling: 'mean', 'max' or 'attention' (parameter free softmax attention of each slice's features to the mean slice features).
+        '''
+        if dataloader is None: dataloader=self.dataloader
+        log('Running Volume Feature Extraction using '+str(self.model_arch)+' architecture with '+pooling+' pooling.')
+        self.labels_idx=[]
+        self.img_path_list=[]
+        features=[]
+        self.model=self.model.to(self.device)
+        self.model.eval()
+        for i, (volumes, labels, paths) in tqdm(enumerate(dataloader), total=len(dataloader)):
+            for volume, label, path in zip(volumes, labels.tolist(), paths):
+                with torch.no_grad():
+                    slice_features=torch.cat([self.model(volume[start:start+slice_batch_size].to(self.device)) for start in range(0, len(volume), slice_batch_size)])
+                    if pooling=='max': pooled=slice_features.max(dim=0)[0]
+                    elif pooling=='attention':
+                        weights=torch.softmax(slice_features@slice_features.mean(dim=0)/math.sqrt(slice_features.shape[1]), dim=0)
+                        pooled=weights@slice_features
+                    else: pooled=slice_features.mean(dim=0)
+                features.append(pooled.cpu().numpy())
+                self.labels_idx.append(label)
+                self.img_path_list.append(path)
         self.feature_names=['f_'+str(i) for i in range(0,self.num_features())]
-        feature_table=pd.DataFrame(list(zip(self.img_path_list, self.labels_idx, self.features)), columns=['IMAGE_PATH','IMAGE_LABEL', 'FEATURES'])
-        feature_table[self.feature_names]=pd.DataFrame(feature_table.FEATURES.values.tolist(), index= feature_table.index)
-        feature_table=feature_table.drop(['FEATURES'], axis=1)
+        feature_table=pd.DataFrame(np.stack(features), columns=self.feature_names)
+        feature_table.insert(0, 'IMAGE_LABEL', self.labels_idx)
+        feature_table.insert(0, 'IMAGE_PATH', self.img_path_list)
         log('Features extracted successfully.')
         self.feature_table=feature_table
         self.features=self.feature_table[self.feature_names]
@@ -373,6 +730,85 @@ class Feature_Extractor():
             raise TypeError('Error! Feature Extractor could not be exported.')
 
 
+class Multi_Feature_Extractor():
+    '''
+    Runs several backbones over one dataloader pass: each batch is loaded/decoded once, resized to each backbone's input size and fed to every backbone in turn.
+    kwargs: feature_extractors (list of Feature_Extractor) or model_arch (list of architectures) with pre_trained, unfreeze, device. dataloader, custom_resize
+    Input size of each backbone is custom_resize if set, else model_dict[model_arch]['input_size']. The dataloader should resize to the largest one, smaller sizes are downsampled with F.interpolate.
+    '''
+    def __init__(self, **kwargs):
+        for k,v in kwargs.items():
+            setattr(self,k,v)
+        if 'feature_extractors' not in kwargs.keys(): self.feature_extractors=[Feature_Extractor(**dict(kwargs, model_arch=i)) for i in self.model_arch]
+        self.model_arch=[i.model_arch for i in self.feature_extractors]
+        if 'device' not in kwargs.keys(): self.device=self.feature_extractors[0].device
+
+    def input_size(self, feature_extractor):
+        custom_resize=getattr(self, 'custom_resize', False)
+        if isinstance(custom_resize, int) and not isinstance(custom_resize, bool) and custom_resize>0: return custom_resize
+        return model_dict[feature_extractor.model_arch]['input_size']
+
+    def store_names(self): #one feature store sub-directory per architecture.
+        names=[]
+        for i in self.model_arch:
+            names.append(i if i not in names else i+'_'+str(len(names)))
+        return names
+
+    def run(self, verbose=False, feature_store=None, dtype='float32', checkpoint_every=20):
+        '''
+        Same arguments as Feature_Extractor.run. feature_store is a directory holding one Feature_Extractor feature store per architecture (see store_names).
+        Results are in each of feature_extractors. With a feature_cache, each backbone runs its own pass over the images missing from its cache.
+        '''
+        log('Running Multi Backbone Feature Extraction using '+', '.join(self.model_arch)+' architectures.')
+        for i in self.feature_extractors: i.dataloader=self.dataloader
+        if any(getattr(i, 'feature_cache', None) for i in self.feature_extractors):
+            for i in self.feature_extractors: i.run(verbose=verbose, dtype=dtype, checkpoint_every=checkpoint_every)
+            return
+        if feature_store: # all stores share one image order, the saved one when resuming.
+            saved=[os.path.join(feature_store, i, 'progress.pkl') for i in self.store_names() if os.path.exists(os.path.join(feature_store, i, 'progress.pkl'))]
+            if len(saved)>0:
+                with open(saved[0], 'rb') as f:
+                    order=pickle.load(f)['order']
+            else: order=list(self.dataloader.sampler)
+            for i in self.feature_extractors: i.dataloader=loader_subset(self.dataloader, order)
+        for i, name in zip(self.feature_extractors, self.store_names()):
+            i._prepare(os.path.join(feature_store, name) if feature_store else None, dtype)
+        dataloader=self._align_stores() if feature_store else self.dataloader
+        if dataloader is None: return
+        sizes=[self.input_size(i) for i in self.feature_extractors]
+        for i in self.feature_extractors:
+            i.device=self.device
+            i._prepare_model()
+        for batch, (imgs, labels, paths) in tqdm(enumerate(dataloader), total=len(dataloader)):
+            imgs=imgs.to(self.device)
+            resized={}
+            for i, size in zip(self.feature_extractors, sizes):
+                if size not in resized: resized[size]=imgs if tuple(imgs.shape[-2:])==(size, size) else F.interpolate(imgs, size=(size, size), mode='bilinear', align_corners=False, antialias=True)
+                i._process_batch(resized[size], labels, paths)
+                if feature_store and (batch+1)%checkpoint_every==0: i._checkpoint()
+        for i in self.feature_extractors:
+            i._finalize()
+        log('Features extracted successfully.')
+        if verbose:
+            for i in self.feature_extractors: print(i.feature_table)
+
+    def _align_stores(self):
+        # Stores resume from the smallest offset reached, stores ahead are rewound to it. Returns the dataloader of remaining images.
+        order=self.feature_extractors[0].progress['order']
+        if any(i.progress['order']!=order for i in self.feature_extractors):
+            log('Error! Feature stores were created with different image orders. Please use a new feature_store directory.')
+            return None
+        offset=min(i.offset for i in self.feature_extractors)
+        for i in self.feature_extractors:
+            if i.offset>offset:
+                i.offset=offset
+                i.img_path_list, i.labels_idx=i.img_path_list[:offset], i.labels_idx[:offset]
+                pd.DataFrame({'IMAGE_PATH':i.img_path_list, 'IMAGE_LABEL':[json.dumps(j) for j in i.labels_idx]}).to_csv(os.path.join(i.feature_store, 'index.csv'), index=False)
+                i.progress['offset']=offset
+                i._checkpoint()
+        return loader_subset(self.feature_extractors[0].dataloader, order[offset:])
+
+
 class Classifier(object):
   '''
   kwargs: feature_table (in case the split is to be done at classifier), extracted_feature_dictionary (dictionary of train/test features), parameters, image_label_column, image_path_column, transformations/model (for prediction)
@@ -404,12 +840,14 @@ class Classifier(object):
         self.train_labels=np.array(self.extracted_feature_dictionary['train']['labels'])
         self.test_features=self.extracted_feature_dictionary['test']['features']
         self.test_labels=np.array(self.extracted_feature_dictionary['test']['labels'])
+        if 'paths' in self.extracted_feature_dictionary['test'].keys(): self.test_paths=self.extracted_feature_dictionary['test']['paths']
 
     else:
         self.feature_names=[x for x in self.feature_table.columns if x not in [self.image_label_column,self.image_path_column]]
         self.labels=self.feature_table[self.image_label_column]
         self.features=self.feature_table[self.feature_names]
         self.train_features,  self.test_features, self.train_labels, self.test_labels=train_test_split(self.features, self.labels, test_size=self.test_percent, random_state=100)
+        if self.image_path_column in self.feature_table.columns: self.test_paths=self.feature_table.loc[self.test_features.index, self.image_path_column].tolist()
 
     if self.interaction_terms:
         log('Creating Interaction Terms for Train Dataset.')
@@ -423,19 +861,20 @@ class Classifier(object):
     self.classifier_type=self.classifier.__class__.__name__
 
   def create_classifier(self, **kw):
+    if self.type in ['linear_regression', 'logistic_regression', 'knn', 'random_forests', 'xgboost']: kw.setdefault('n_jobs', getattr(self, 'n_jobs', -1)) # n_jobs in parameters takes precedence.
     if self.type not in SUPPORTED_CLASSIFIER:
       log('Error! Classifier type not supported. Please check again.')
       pass
     elif self.type=='linear_regression':
-      classifier=LinearRegression(n_jobs=-1, **kw)
+      classifier=LinearRegression(**kw)
     elif self.type=='logistic_regression':
-      classifier=LogisticRegression(max_iter=10000,n_jobs=-1, **kw)
+      classifier=LogisticRegression(max_iter=10000, **kw)
     elif self.type=='ridge':
       classifier=RidgeClassifier(max_iter=10000, **kw)
     elif self.type=='sgd':
       classifier=SGDClassifier(**kw)
     elif self.type=='knn':
-      classifier=KNeighborsClassifier(n_jobs=-1,**kw)
+      classifier=KNeighborsClassifier(**kw)
     elif self.type=='decision_trees':
       classifier=tree.DecisionTreeClassifier(**kw)
     elif self.type=='random_forests':
@@ -558,9 +997,7 @@ class Classifier(object):
       true_labels=self.test_labels.tolist()
       accuracy_list=[0.0]*len(true_labels)
 
-      y = copy.deepcopy(self.test_features)
-      paths=[]
-      for i in y.index.tolist():paths.append(self.test_feature_extractor.feature_table.iloc[i]['IMAGE_PATH'])  # <<<<< this line was changed .. check. / Accuracy not showing correctly !!
+      paths=self.test_paths
 
       misclassified_dict=misclassified(true_labels_list=true_labels, predicted_labels_list=pred_labels, accuracy_list=accuracy_list, img_path_list=paths)
       show_misclassified(misclassified_dictionary=misclassified_dict, transforms=self.data_processor.transformations, class_to_idx_dict=self.data_processor.classes(), is_dicom = self.is_dicom, num_of_images = num_of_images, figure_size =figure_size)
@@ -886,7 +1323,7 @@ class NN_Classifier():
         model=self.model
         train_data_loader=self.train_dataloader
         valid_data_loader=self.valid_dataloader
-        train_data_set=self.train_dataset
+        train_data_size=len(train_data_loader.sampler) # epoch size, differs from len(train_dataset) with balance_class sampling.
         valid_data_set=self.valid_dataset
         loss_criterion=self.loss_function
         optimizer=self.optimizer
@@ -954,8 +1391,8 @@ class NN_Classifier():
                     # Compute total accuracy in the whole batch and add to valid_acc
                     valid_acc += acc.item() * inputs.size(0)
             # Find average training loss and training accuracy
-            avg_train_loss=train_loss/len(train_data_set)
-            avg_train_acc=train_acc/len(train_data_set)
+            avg_train_loss=train_loss/train_data_size
+            avg_train_acc=train_acc/train_data_size
             # Find average validation loss and training accuracy
             avg_valid_loss=valid_loss/len(valid_data_set)
             avg_valid_acc=valid_acc/len(valid_data_set)
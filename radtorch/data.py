@@ -40,24 +40,94 @@ def over_sample(dataset, shuffle=True, **kwargs):
     return balanced_dataset
 
 
+def tensor_moments(images):
+    # Per channel pixel count, mean and sum of squared deviations (M2) of an image batch (N, C, H, W), plus per image channel means.
+    images=images.double()
+    channels=images.transpose(0, 1).reshape(images.size(1), -1)
+    mean=channels.mean(1)
+    m2=((channels-mean.unsqueeze(1))**2).sum(1)
+    return channels.size(1), mean, m2, images.mean(dim=(2, 3))
+
+
+def merge_moments(a, b):
+    # Chan et al. parallel merge of two (count, mean, M2, image_means) partial results.
+    if a is None: return b
+    n_a, mean_a, m2_a, image_means_a=a
+    n_b, mean_b, m2_b, image_means_b=b
+    n=n_a+n_b
+    delta=mean_b-mean_a
+    return n, mean_a+delta*n_b/n, m2_a+m2_b+delta**2*n_a*n_b/n, torch.cat([image_means_a, image_means_b])
+
+
+def moments_collate(batch, batch_transform=None):
+    # collate_fn computing moments inside DataLoader workers so only statistics, not images, are sent to the main process.
+    images=torch.stack([i[0] for i in batch])
+    if batch_transform is not None: images=batch_transform(images)
+    return tensor_moments(images)
+
+
 def calculate_mean_std(dataloader):
     '''
-    Source
-    -------
-    https://discuss.pytorch.org/t/about-normalization-using-pre-trained-vgg16-networks/23560/6
+    Pooled per channel mean and standard deviation over all pixels of all images returned by dataloader, streamed batch by batch.
     '''
-    mean = 0.
-    std = 0.
-    nb_samples = 0.
+    moments=None
     for data, labels, paths in tqdm(dataloader, total=len(dataloader)):
-        batch_samples = data.size(0)
-        data = data.view(batch_samples, data.size(1), -1)
-        mean += data.mean(2).sum(0)
-        std += data.std(2).sum(0)
-        nb_samples += batch_samples
-    mean /= nb_samples
-    std /= nb_samples
-    return (mean, std)
+        moments=merge_moments(moments, tensor_moments(data))
+    n, mean, m2, image_means=moments
+    return mean.float(), (m2/(n-1)).sqrt().float()
+
+
+mean_std_cache={}
+
+def stratified_sample(labels, sample, random_state=100):
+    # Indices of a class stratified random sample. sample: fraction (float) or total number of images (int).
+    rng=np.random.default_rng(random_state)
+    fraction=sample if isinstance(sample, float) else min(1.0, sample/len(labels))
+    indices=[]
+    for label in np.unique(labels):
+        class_indices=np.flatnonzero(labels==label)
+        indices.append(rng.choice(class_indices, size=max(1, int(round(fraction*len(class_indices)))), replace=False))
+    return np.sort(np.concatenate(indices))
+
+
+def dataset_mean_std(dataset, batch_size=64, num_workers=0, sample=None, confidence=0.95, random_state=100, cache=True, cache_file=None):
+    '''
+    One pass streaming estimate of per channel mean and standard deviation of a RADTorch_Dataset after its transformations.
+    Moments are computed per batch in the DataLoader workers and merged in the main process.
+    sample: optional fraction or number of images drawn with class stratification. The result then includes mean_margin,
+    the half width of the confidence interval of the mean (normal approximation over per image means).
+    Results are cached by image list, labels, transformations, mode, wl and sample, in memory and in cache_file if supplied.
+    '''
+    index=dataset.data_index
+    signature=hashlib.sha1()
+    for i in [index.path_buffer.tobytes(), index.path_offsets.tobytes(), index.labels.tobytes(), repr((dataset.transformations, getattr(dataset, 'batch_transform', None), dataset.mode, dataset.wl, sample, random_state)).encode()]:
+        signature.update(i)
+    key=signature.hexdigest()
+    if cache and cache_file and os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            mean_std_cache.update(pickle.load(f))
+    if cache and key in mean_std_cache:
+        log('Mean and standard deviation loaded from cache.')
+        return mean_std_cache[key]
+
+    if sample is None: indices=np.arange(len(dataset))
+    else: indices=stratified_sample(index.labels, sample, random_state)
+    dataloader=torch.utils.data.DataLoader(dataset=torch.utils.data.Subset(dataset, indices.tolist()), batch_size=batch_size, shuffle=False, num_workers=num_workers, collate_fn=functools.partial(moments_collate, batch_transform=getattr(dataset, 'batch_transform', None)))
+    moments=None
+    for batch_moments in tqdm(dataloader, total=len(dataloader)):
+        moments=merge_moments(moments, batch_moments)
+    n, mean, m2, image_means=moments
+    result={'mean':tuple(mean.tolist()), 'std':tuple((m2/(n-1)).sqrt().tolist()), 'num_images':len(indices)}
+    if sample is not None and len(indices)>1:
+        z=statistics.NormalDist().inv_cdf((1+confidence)/2)
+        finite_population=math.sqrt(1-len(indices)/len(dataset))
+        result['mean_margin']=tuple((z*image_means.std(0)/math.sqrt(len(indices))*finite_population).tolist())
+    if cache:
+        mean_std_cache[key]=result
+        if cache_file:
+            with open(cache_file, 'wb') as f:
+                pickle.dump(mean_std_cache, f)
+    return result
 
 
 def balance_dataset(dataset, label_col, upsample=True):
@@ -122,16 +192,708 @@ def set_random_seed(seed):
         pass
 
 
-def list_of_files(root):
-    listOfFile = os.listdir(root)
-    allFiles = list()
-    for entry in listOfFile:
-        fullPath = os.path.join(root, entry)
-        if os.path.isdir(fullPath):
-            allFiles = allFiles + list_of_files(fullPath)
+class Pixel_Cache():
+    '''
+    On-disk cache of decoded DICOM arrays (after RAW/HU/WIN/MWIN conversion).
+    Entries are keyed by file path, mtime, size, mode and wl, stored as .npy files and returned memory-mapped.
+    Least recently used entries are evicted once the cache grows above max_size (bytes).
+    kwargs: cache_dir, max_size
+    '''
+    def __init__(self, cache_dir, max_size=10*1024**3):
+        self.cache_dir=cache_dir
+        self.max_size=max_size
+        Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+        self.current_size=sum(e.stat().st_size for e in os.scandir(self.cache_dir) if e.name.endswith('.npy'))
+
+    def key(self, filepath, mode='RAW', wl=None, **kwargs):
+        stat=os.stat(filepath)
+        signature=repr((os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size, mode, wl, sorted(kwargs.items())))
+        return hashlib.sha1(signature.encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key+'.npy')
+
+    def get(self, key):
+        path=self.entry_path(key)
+        try:
+            array=np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        os.utime(path) # file mtime is used as the LRU clock.
+        return array
+
+    def put(self, key, array):
+        path=self.entry_path(key)
+        temp_path=path+'.'+str(os.getpid())+'.tmp'
+        with open(temp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(temp_path, path) # atomic, safe with several DataLoader workers writing the same entry.
+        self.current_size+=os.path.getsize(path)
+        if self.current_size>self.max_size:
+            self.evict()
+
+    def evict(self, target=0.9):
+        entries=[(e.stat().st_mtime, e.stat().st_size, e.path) for e in os.scandir(self.cache_dir) if e.name.endswith('.npy')]
+        entries.sort()
+        total=sum(i[1] for i in entries)
+        for mtime, size, path in entries:
+            if total<=target*self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total-=size
+        self.current_size=total
+
+    def load(self, filepath, mode='RAW', wl=None, target_size=None):
+        key=self.key(filepath, mode, wl, target_size=target_size)
+        array=self.get(key)
+        if array is None:
+            array=dicom_to_narray(filepath, mode, wl, target_size)
+            if array is not None:
+                self.put(key, array)
+        return array
+
+    def clear(self):
+        for e in os.scandir(self.cache_dir):
+            if e.name.endswith('.npy'):
+                os.remove(e.path)
+        self.current_size=0
+
+
+class Feature_Cache():
+    '''
+    Persistent cache of extracted image features shared across runs.
+    open() selects a namespace (subdirectory) from model_arch and a hash of the model weights.
+    Within a namespace, features of each image are keyed by file path, mtime, size and a signature of the dataset transformations and mode/wl/decode_size,
+    and stored in chunk_*.npy files, each with a .keys.pkl list of its keys.
+    Chunks are only added, never rewritten, so several runs can fill the same cache.
+    kwargs: cache_dir
+    '''
+    def __init__(self, cache_dir):
+        self.cache_dir=cache_dir
+        Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+        self.namespace_dir=None
+        self.index={}
+        self.chunks={}
+
+    def open(self, model, model_arch):
+        weights=hashlib.sha1()
+        for name, tensor in sorted(model.state_dict().items()):
+            weights.update(name.encode())
+            weights.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+        signature=repr((model_arch, weights.hexdigest()))
+        self.namespace_dir=os.path.join(self.cache_dir, hashlib.sha1(signature.encode()).hexdigest())
+        Path(self.namespace_dir).mkdir(exist_ok=True)
+        self.index={}
+        self.chunks={}
+        for e in os.scandir(self.namespace_dir):
+            if e.name.endswith('.keys.pkl'):
+                with open(e.path, 'rb') as f:
+                    chunk=e.name[:-len('.keys.pkl')]
+                    self.index.update({key:(chunk, row) for row, key in enumerate(pickle.load(f))})
+        return self
+
+    def dataset_signature(self, dataset):
+        # Hash of everything in a dataset that changes the image given to the model.
+        signature=repr((repr(getattr(dataset, 'transformations', None)), repr(getattr(dataset, 'batch_transform', None)),
+                        getattr(dataset, 'is_dicom', None), getattr(dataset, 'mode', None), getattr(dataset, 'wl', None), getattr(dataset, 'decode_size', None)))
+        return hashlib.sha1(signature.encode()).hexdigest()
+
+    def image_key(self, filepath, dataset_signature=''):
+        stat=os.stat(filepath)
+        return (os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size, dataset_signature)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def chunk(self, name):
+        if name not in self.chunks:
+            self.chunks[name]=np.load(os.path.join(self.namespace_dir, name+'.npy'), mmap_mode='r')
+        return self.chunks[name]
+
+    def get(self, keys, out=None):
+        # Features of keys as one matrix, rows read chunk by chunk.
+        locations=[self.index[k] for k in keys]
+        names=np.array([i[0] for i in locations])
+        rows=np.array([i[1] for i in locations], dtype='int64')
+        for name in np.unique(names):
+            chunk=self.chunk(name)
+            if out is None: out=np.empty((len(keys), chunk.shape[1]), dtype=chunk.dtype)
+            mask=names==name
+            out[mask]=chunk[rows[mask]]
+        return out
+
+    def put(self, keys, features):
+        if len(keys)==0: return
+        name='chunk_'+hashlib.sha1(repr(keys).encode()).hexdigest()[:16]
+        path=os.path.join(self.namespace_dir, name)
+        with open(path+'.npy.tmp', 'wb') as f:
+            np.save(f, np.ascontiguousarray(features))
+        os.replace(path+'.npy.tmp', path+'.npy')
+        with open(path+'.keys.pkl.tmp', 'wb') as f:
+            pickle.dump(list(keys), f)
+        os.replace(path+'.keys.pkl.tmp', path+'.keys.pkl') # keys are written last, a chunk without keys is ignored.
+        self.index.update({key:(name, row) for row, key in enumerate(keys)})
+
+
+def multi_hot_encode(labels, class_to_idx):
+    # uint8 matrix (rows x classes) with 1 where the class is in the row's list of labels. Labels not in class_to_idx are ignored.
+    exploded=labels.reset_index(drop=True).explode()
+    codes=exploded.map(class_to_idx).to_numpy()
+    valid=pd.notna(codes)
+    multi_hot=np.zeros((len(labels), len(class_to_idx)), dtype='uint8')
+    multi_hot[exploded.index.to_numpy()[valid], codes[valid].astype('int64')]=1
+    return multi_hot
+
+
+class Dataset_Index():
+    '''
+    Compact columnar index of a dataset table used by RADTorch_Dataset.__getitem__ instead of pandas lookups.
+    Image paths are kept as one UTF-8 buffer with offsets, labels as int32 class indices (-1 if not in class_to_idx)
+    and, for multi label datasets, a uint8 multi-hot matrix.
+    '''
+    __slots__=('path_buffer', 'path_offsets', 'labels', 'multi_hot')
+
+    def __init__(self, table, image_path_column, image_label_column, class_to_idx, multi_label=False):
+        encoded_paths=[str(i).encode('utf-8') for i in table[image_path_column]]
+        self.path_buffer=np.frombuffer(b''.join(encoded_paths), dtype='uint8')
+        self.path_offsets=np.zeros(len(encoded_paths)+1, dtype='int64')
+        np.cumsum([len(i) for i in encoded_paths], out=self.path_offsets[1:])
+        if multi_label:
+            self.labels=np.full(len(table), -1, dtype='int32')
+            self.multi_hot=multi_hot_encode(table[image_label_column], class_to_idx)
         else:
-            allFiles.append(fullPath)
-    return allFiles
+            self.labels=table[image_label_column].map(class_to_idx).fillna(-1).to_numpy(dtype='int32')
+            self.multi_hot=None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def path(self, index):
+        return self.path_buffer[self.path_offsets[index]:self.path_offsets[index+1]].tobytes().decode('utf-8')
+
+
+class Batch_Normalize():
+    '''
+    Converts a uint8 image batch to float in [0, 1] and normalizes it with mean/std in one vectorized operation per batch.
+    '''
+    def __init__(self, mean=None, std=None, scale=255.0):
+        self.scale=scale
+        self.mean=None if mean is None else torch.as_tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std=None if std is None else torch.as_tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+
+    def __call__(self, images):
+        images=images.float().div_(self.scale)
+        if self.mean is not None:
+            images.sub_(self.mean).div_(self.std)
+        return images
+
+    def __repr__(self):
+        return self.__class__.__name__+'(mean={0}, std={1})'.format(None if self.mean is None else self.mean.flatten().tolist(), None if self.std is None else self.std.flatten().tolist())
+
+
+def defer_tensor_transformations(transformations):
+    # Returns equivalent (per sample uint8 transformations, Batch_Normalize): ToTensor is replaced by PILToTensor and Normalize moves to the batch.
+    stages=[]
+    mean, std=None, None
+    for t in transformations.transforms:
+        if isinstance(t, transforms.ToTensor): stages.append(transforms.PILToTensor())
+        elif isinstance(t, transforms.Normalize): mean, std=t.mean, t.std
+        else: stages.append(t)
+    return transforms.Compose(stages), Batch_Normalize(mean=mean, std=std)
+
+
+class Deferred_Transform_Loader():
+    '''
+    Wraps a DataLoader whose workers return uint8 image batches and applies batch_transform (e.g. Batch_Normalize) to every batch in the main process.
+    '''
+    def __init__(self, dataloader, batch_transform):
+        self.dataloader=dataloader
+        self.batch_transform=batch_transform
+
+    def __iter__(self):
+        for images, labels, paths in self.dataloader:
+            yield self.batch_transform(images), labels, paths
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __getattr__(self, name):
+        if name in ['dataloader', 'batch_transform']:
+            raise AttributeError(name)
+        return getattr(self.dataloader, name)
+
+
+def balanced_sampler(labels, num_samples=None, upsample=True, random_state=None):
+    # Draws indices with probability inversely proportional to class frequency so that all classes are sampled equally, without copying dataset rows.
+    # num_samples (epoch size) defaults to number of classes x size of largest class (upsample) or smallest class (downsample).
+    classes, inverse, counts=np.unique(np.asarray(labels), return_inverse=True, return_counts=True)
+    weights=torch.from_numpy(1.0/counts[inverse])
+    if num_samples is None: num_samples=(counts.max() if upsample else counts.min())*len(classes)
+    generator=None if random_state is None else torch.Generator().manual_seed(random_state)
+    return torch.utils.data.WeightedRandomSampler(weights, num_samples=int(num_samples), replacement=True, generator=generator)
+
+
+class Read_Ahead():
+    '''
+    Reads raw file bytes ahead of use on a thread pool, for filesystems where latency and not decoding dominates (e.g. NFS).
+    The expected order of files is set with plan() (see Read_Ahead_Sampler). get(path) returns an io.BytesIO of the file,
+    waiting for its read if still in progress. At most depth files are being read or kept in the buffer at a time.
+    In DataLoader workers, each worker reads ahead the batches it will receive (batches are dispatched to workers round-robin).
+    stats() returns counters shared by all workers: hits (ready when requested), waits (requested while being read),
+    misses (not planned, read on request), mean wait and read latency and mean/max number of buffered files.
+    '''
+    def __init__(self, depth=32, num_threads=8):
+        self.depth=depth
+        self.num_threads=num_threads
+        self.order=[]
+        self.batch_size=1
+        self.num_workers=0
+        self.batch_ids=None
+        self.counters=multiprocessing.Array('d', 8) # hits, waits, misses, wait time, read time, reads, buffered sum, max buffered
+        self.reset()
+
+    def reset(self):
+        self.pid=os.getpid()
+        self.executor=None
+        self.queue=deque()
+        self.buffer={}
+        self.started=False
+
+    def plan(self, paths, batch_size=1, num_workers=0, batch_ids=None): # paths in the order they will be requested next epoch, batch_ids: position of each batch among all batches of the DataLoader (default 0, 1, 2...).
+        self.order=list(paths)
+        self.batch_size=batch_size
+        self.num_workers=num_workers
+        self.batch_ids=batch_ids
+
+    def start(self, paths=None):
+        if self.executor is not None: self.executor.shutdown(wait=False, cancel_futures=True)
+        self.reset()
+        if paths is None:
+            paths=self.order
+            worker_info=torch.utils.data.get_worker_info()
+            if worker_info is not None:
+                batches=[paths[i:i+self.batch_size] for i in range(0, len(paths), self.batch_size)]
+                batch_ids=getattr(self, 'batch_ids', None) or range(len(batches))
+                paths=[path for batch, batch_id in zip(batches, batch_ids) if batch_id%worker_info.num_workers==worker_info.id for path in batch]
+        self.queue.extend(paths)
+        self.executor=concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads)
+        self.started=True
+        self.fill()
+
+    def read(self, path):
+        start=time.perf_counter()
+        with open(path, 'rb') as f:
+            data=f.read()
+        return data, time.perf_counter()-start
+
+    def fill(self):
+        while self.queue and len(self.buffer)<self.depth:
+            path=self.queue.popleft()
+            if path in self.buffer: self.buffer[path][1]+=1
+            else: self.buffer[path]=[self.executor.submit(self.read, path), 1]
+
+    def get(self, path):
+        if os.getpid()!=self.pid: self.reset() # new DataLoader worker, threads of the parent process are not inherited.
+        if not self.started: self.start()
+        entry=self.buffer.get(path)
+        wait=0.0
+        if entry is None:
+            counter=2
+            data, latency=self.read(path)
+        else:
+            counter=0 if entry[0].done() else 1
+            start=time.perf_counter()
+            data, latency=entry[0].result()
+            wait=time.perf_counter()-start
+            entry[1]-=1
+            if entry[1]==0: del self.buffer[path]
+        with self.counters.get_lock():
+            self.counters[counter]+=1
+            self.counters[3]+=wait
+            self.counters[4]+=latency
+            self.counters[5]+=1
+            self.counters[6]+=len(self.buffer)
+            self.counters[7]=max(self.counters[7], len(self.buffer))
+        self.fill()
+        return io.BytesIO(data)
+
+    def stats(self):
+        hits, waits, misses, wait_time, read_time, reads, buffered, max_buffered=self.counters[:]
+        reads=max(reads, 1)
+        return {'depth':self.depth, 'hits':int(hits), 'waits':int(waits), 'misses':int(misses), 'mean_wait_ms':1000*wait_time/reads, 'mean_read_ms':1000*read_time/reads, 'mean_buffered':buffered/reads, 'max_buffered':int(max_buffered)}
+
+    def reset_stats(self):
+        with self.counters.get_lock():
+            self.counters[:]=[0]*8
+
+    def __getstate__(self): # threads and futures are not pickled, workers start their own.
+        state=self.__dict__.copy()
+        state.update({'executor':None, 'queue':deque(), 'buffer':{}, 'started':False})
+        if multiprocessing.context.get_spawning_popen() is None: state['counters']=self.counters[:] # shared counters only go to spawned workers, copies and exports keep their values.
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.counters, list): self.counters=multiprocessing.Array('d', self.counters)
+
+
+class Read_Ahead_Sampler(torch.utils.data.Sampler):
+    '''
+    Wraps a sampler so that the dataset's Read_Ahead knows upcoming indices. The order of each epoch is drawn one epoch in advance,
+    so DataLoader workers, which copy the dataset when the epoch starts, already have it. Not for use with persistent_workers.
+    '''
+    def __init__(self, sampler, dataset, batch_size=1, num_workers=0):
+        self.sampler=sampler
+        self.dataset=dataset
+        self.batch_size=batch_size
+        self.num_workers=num_workers
+        self.next_order=self.plan()
+
+    def plan(self):
+        order=list(self.sampler)
+        self.dataset.read_ahead.plan([self.dataset.data_index.path(i) for i in order], self.batch_size, self.num_workers)
+        return order
+
+    def __iter__(self):
+        order=self.next_order
+        if self.num_workers==0: self.dataset.read_ahead.start()
+        self.next_order=self.plan()
+        return iter(order)
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+def create_dataloader(dataset, **kwargs):
+    # DataLoader for a dataset, returning uint8 batches normalized in the main process if the dataset has a batch_transform.
+    # Datasets with read_ahead get their sampler wrapped in a Read_Ahead_Sampler.
+    if isinstance(getattr(dataset, 'read_ahead', None), Read_Ahead):
+        sampler=kwargs.pop('sampler', None)
+        if sampler is None:
+            sampler=torch.utils.data.RandomSampler(dataset) if kwargs.pop('shuffle', False) else torch.utils.data.SequentialSampler(dataset)
+        kwargs['sampler']=Read_Ahead_Sampler(sampler, dataset, batch_size=kwargs.get('batch_size', 1), num_workers=kwargs.get('num_workers', 0))
+    batch_transform=getattr(dataset, 'batch_transform', None)
+    if batch_transform is None:
+        return torch.utils.data.DataLoader(dataset=dataset, **kwargs)
+    return Deferred_Transform_Loader(torch.utils.data.DataLoader(dataset=dataset, **kwargs), batch_transform)
+
+
+def dataset_item(dataset, index):
+    # (dataset, index) of the RADTorch dataset holding item index of dataset, which can be a ConcatDataset.
+    if isinstance(dataset, torch.utils.data.ConcatDataset):
+        k=bisect.bisect_right(dataset.cumulative_sizes, index)
+        if k>0: index-=dataset.cumulative_sizes[k-1]
+        return dataset_item(dataset.datasets[k], index)
+    return dataset, index
+
+
+def item_path_label(dataset, index):
+    # Image path and label of an item from the dataset index, without loading the image.
+    dataset, index=dataset_item(dataset, index)
+    if dataset.multi_label: return dataset.data_index.path(index), dataset.data_index.multi_hot[index].tolist()
+    return dataset.data_index.path(index), int(dataset.data_index.labels[index])
+
+
+class Split_Loader():
+    '''
+    Loads several split datasets (e.g. {'train':..., 'test':...}) in one pass with one DataLoader over their ConcatDataset.
+    order: indices into the ConcatDataset (datasets in dictionary order) in the order they are loaded.
+    Batches never mix splits, so each split keeps its own transformations and batch_transform.
+    Items of a split are batched together as they come, so the loading order can differ from order. With preserve_order, a batch is also closed whenever the split changes and items load exactly in order.
+    split_list: split of each image in loading order.
+    '''
+    def __init__(self, datasets, order, batch_size=16, num_workers=0, preserve_order=False):
+        self.datasets=datasets
+        self.batch_size=batch_size
+        self.num_workers=num_workers
+        self.dataset=torch.utils.data.ConcatDataset(list(datasets.values()))
+        names=list(datasets.keys())
+        self.batches=[]
+        self.batch_splits=[]
+        pending={}
+        for i in order:
+            split=names[bisect.bisect_right(self.dataset.cumulative_sizes, i)]
+            if preserve_order and len(pending)>0 and split not in pending:
+                for pending_split, batch in pending.items():
+                    self.batches.append(batch)
+                    self.batch_splits.append(pending_split)
+                pending={}
+            pending.setdefault(split, []).append(i)
+            if len(pending[split])==batch_size:
+                self.batches.append(pending.pop(split))
+                self.batch_splits.append(split)
+        for split, batch in pending.items():
+            self.batches.append(batch)
+            self.batch_splits.append(split)
+        self.sampler=[i for batch in self.batches for i in batch]
+        self.split_list=[split for batch, split in zip(self.batches, self.batch_splits) for i in batch]
+        self.batch_transforms={k:getattr(v, 'batch_transform', None) for k, v in datasets.items()}
+        self.dataloader=torch.utils.data.DataLoader(self.dataset, batch_sampler=self.batches, num_workers=num_workers)
+
+    def plan_read_ahead(self):
+        # Plans the Read_Ahead of each split dataset with the batches of its split. DataLoader workers receive batches round-robin over all splits' batches.
+        for split, dataset in self.datasets.items():
+            if not isinstance(getattr(dataset, 'read_ahead', None), Read_Ahead): continue
+            batch_ids=[i for i, batch_split in enumerate(self.batch_splits) if batch_split==split]
+            paths=[item_path_label(self.dataset, i)[0] for batch_id in batch_ids for i in self.batches[batch_id]]
+            dataset.read_ahead.plan(paths, self.batch_size, self.num_workers, batch_ids)
+            if self.num_workers==0: dataset.read_ahead.start()
+
+    def __iter__(self):
+        self.plan_read_ahead() # planned when iteration starts, workers copy the datasets with the plan.
+        for split, (images, labels, paths) in zip(self.batch_splits, self.dataloader):
+            if self.batch_transforms[split] is not None: images=self.batch_transforms[split](images)
+            yield images, labels, paths
+
+    def __len__(self):
+        return len(self.batches)
+
+    def subset(self, order): #loader over the items order, loaded exactly in that order (see loader_subset).
+        return Split_Loader(self.datasets, order, batch_size=self.batch_size, num_workers=self.num_workers, preserve_order=True)
+
+
+def loader_subset(dataloader, order):
+    # Loader over the items order (indices into dataloader.dataset) with the batch size and workers of dataloader.
+    if isinstance(dataloader, Split_Loader): return dataloader.subset(order)
+    return create_dataloader(dataloader.dataset, sampler=order, batch_size=dataloader.batch_size, num_workers=dataloader.num_workers)
+
+
+def pil_to_array(image):
+    return np.array(image)
+
+
+def array_to_tensor(array): #(rows, columns[, channels]) array to a (channels, rows, columns) tensor keeping its dtype, like PILToTensor.
+    array=np.asarray(array)
+    if array.ndim==2: array=array[:, :, np.newaxis]
+    return torch.from_numpy(np.ascontiguousarray(array.transpose(2, 0, 1)))
+
+
+def split_transformations(transformations):
+    # Splits a Compose into the image stages (decode/resize, before ToTensor/PILToTensor) and the tensor stages (ToTensor/PILToTensor and after).
+    stages=transformations.transforms
+    tensor_stage=[i for i, t in enumerate(stages) if isinstance(t, (transforms.ToTensor, transforms.PILToTensor))]
+    if len(tensor_stage)==0:
+        raise TypeError('Error! Transformations must include ToTensor or PILToTensor to be exported to shards.')
+    return transforms.Compose(stages[:tensor_stage[0]]), transforms.Compose(stages[tensor_stage[0]:])
+
+
+def export_dataset_shards(dataset, output_directory, transformations=None, shard_size=4096, batch_size=64, num_workers=0):
+    '''
+    Writes the images of a dataset, decoded, windowed and resized (all transformations before ToTensor), to fixed-shape .npy shards
+    of shard_size images each, plus an index table of image path, label, shard and offset. Use Dataset_from_shards to read them back.
+    The batch_transform of a deferred normalize dataset (Batch_Normalize) is saved with the shards and applied by Dataset_from_shards.
+    '''
+    if transformations is None:
+        transformations=dataset.transformations
+    image_transformations, tensor_transformations=split_transformations(transformations)
+    image_transformations.transforms.append(transforms.Lambda(pil_to_array))
+    export_dataset=copy.copy(dataset)
+    export_dataset.transformations=image_transformations
+    dataloader=torch.utils.data.DataLoader(dataset=export_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    Path(output_directory).mkdir(parents=True, exist_ok=True)
+    num_images=len(export_dataset)
+    shard=None
+    paths, labels, shard_ids, offsets=[], [], [], []
+    position=0
+    for imgs, label_idx, image_paths in tqdm(dataloader, total=len(dataloader)):
+        imgs=imgs.numpy()
+        for i in range(imgs.shape[0]):
+            shard_id, offset=divmod(position, shard_size)
+            if offset==0:
+                if shard is not None: shard.flush()
+                shard=np.lib.format.open_memmap(os.path.join(output_directory, 'shard_'+str(shard_id).zfill(5)+'.npy'), mode='w+', dtype=imgs.dtype, shape=(min(shard_size, num_images-position),)+imgs.shape[1:])
+            shard[offset]=imgs[i]
+            shard_ids.append(shard_id)
+            offsets.append(offset)
+            position+=1
+        paths+=list(image_paths)
+        labels+=label_idx.tolist()
+    if shard is not None: shard.flush()
+    index=pd.DataFrame({dataset.image_path_column:paths, 'LABEL_IDX':labels, 'SHARD':shard_ids, 'OFFSET':offsets})
+    idx_to_class={v:k for k, v in dataset.class_to_idx.items()}
+    index[dataset.image_label_column]=[idx_to_class[i] for i in labels]
+    index.to_csv(os.path.join(output_directory, 'index.csv'), index=False)
+    meta={'classes':dataset.classes, 'class_to_idx':dataset.class_to_idx, 'image_path_column':dataset.image_path_column, 'image_label_column':dataset.image_label_column, 'is_dicom':dataset.is_dicom, 'mode':dataset.mode, 'wl':dataset.wl}
+    if getattr(dataset, 'batch_transform', None) is not None: meta['batch_transform']=dataset.batch_transform
+    with open(os.path.join(output_directory, 'shards.pkl'), 'wb') as f:
+        pickle.dump(meta, f)
+    log(str(position)+' images exported to '+str(len(set(shard_ids)))+' shards in '+output_directory)
+    return index
+
+
+def scan_directory(path, previous_scan={}):
+    # Returns (mtime, files, directories) of one directory. A directory mtime only changes when its own entries change,
+    # so an unchanged mtime means the listing saved in previous_scan can be re-used without listing the directory again.
+    mtime=os.stat(path).st_mtime_ns
+    if path in previous_scan and previous_scan[path][0]==mtime:
+        return previous_scan[path]
+    files=[]
+    directories=[]
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                directories.append(entry.path)
+            else:
+                files.append(entry.path)
+    return (mtime, files, directories)
+
+
+def scan_files(root, extensions=None, num_workers=8, manifest=None):
+    '''
+    Generator of all files under root. Directories are listed with os.scandir on a thread pool, in parallel.
+    extensions: tuple of file extensions to return. Returns all files if None.
+    manifest: path of a file where directory listings are saved. Later scans using the same manifest only list directories whose mtime changed.
+    '''
+    previous_scan={}
+    if manifest and os.path.exists(manifest):
+        with open(manifest, 'rb') as f:
+            previous_scan=pickle.load(f)
+    current_scan={}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending={executor.submit(scan_directory, root, previous_scan):root}
+        while pending:
+            done, not_done=concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path=pending.pop(future)
+                current_scan[path]=future.result()
+                mtime, files, directories=current_scan[path]
+                for directory in directories:
+                    pending[executor.submit(scan_directory, directory, previous_scan)]=directory
+                for file in files:
+                    if extensions is None or file.endswith(extensions):
+                        yield file
+    if manifest:
+        temp_manifest=manifest+'.tmp'
+        with open(temp_manifest, 'wb') as f:
+            pickle.dump(current_scan, f)
+        os.replace(temp_manifest, manifest)
+
+
+def list_of_files(root, extensions=None, **kwargs):
+    return sorted(scan_files(root, extensions=extensions, **kwargs))
+
+
+def safe_read_dicom_header(filepath):
+    try:
+        return read_dicom_header(filepath)
+    except Exception:
+        return None
+
+
+def build_dicom_catalog(root, catalog_path=None, num_workers=8):
+    '''
+    Creates a table with header information (see DICOM_CATALOG_TAGS) of all DICOM files in root, reading headers only, in parallel.
+    If catalog_path is supplied, the table is saved there as Parquet and a later build only parses files whose modification time or size changed.
+    '''
+    files=list_of_files(root, extensions=('.dcm',))
+    stats=[os.stat(x) for x in files]
+    current=pd.DataFrame({'IMAGE_PATH':files, 'FILE_MTIME':[x.st_mtime_ns for x in stats], 'FILE_SIZE':[x.st_size for x in stats]})
+    if catalog_path and os.path.exists(catalog_path):
+        previous=pd.read_parquet(catalog_path)
+        unchanged=current.merge(previous, on=['IMAGE_PATH', 'FILE_MTIME', 'FILE_SIZE'], how='inner')
+        changed=current[~current['IMAGE_PATH'].isin(unchanged['IMAGE_PATH'])].reset_index(drop=True)
+    else:
+        unchanged=None
+        changed=current
+    log('Building DICOM catalog: '+str(len(changed))+' new or modified files to parse out of '+str(len(current))+'.')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        headers=list(tqdm(executor.map(safe_read_dicom_header, changed['IMAGE_PATH']), total=len(changed)))
+    failed=[i for i, h in enumerate(headers) if h is None]
+    if len(failed)>0:
+        log('Warning! '+str(len(failed))+' files could not be read and were excluded from the catalog.')
+    columns=list(DICOM_CATALOG_TAGS.keys())+['TransferSyntaxUID']
+    parsed=pd.concat([changed.drop(failed).reset_index(drop=True), pd.DataFrame([h for h in headers if h is not None], columns=columns)], axis=1)
+    catalog=pd.concat([unchanged, parsed], ignore_index=True) if unchanged is not None else parsed
+    if catalog_path:
+        catalog.to_parquet(catalog_path, index=False)
+        log('DICOM catalog saved to '+catalog_path)
+    return catalog
+
+
+def load_dicom_catalog(catalog):
+    '''
+    Loads a catalog created by build_dicom_catalog (path or DataFrame) and fills the rescale parameters cache from it
+    so windowing does not need to look up Modality/RescaleSlope/RescaleIntercept again.
+    '''
+    if isinstance(catalog, str):
+        catalog=pd.read_parquet(catalog)
+    for path, modality, slope, intercept in zip(catalog['IMAGE_PATH'], catalog['Modality'], catalog['RescaleSlope'], catalog['RescaleIntercept']):
+        if modality=='CT' and pd.notna(slope) and pd.notna(intercept):
+            rescale_cache[path]=(modality, float(slope), float(intercept))
+        else:
+            rescale_cache[path]=(modality, 1.0, 0.0)
+    return catalog
+
+
+image_hash_cache={}
+
+
+def image_hashes(filepath):
+    # Returns (sha1 of pixel array, 64 bit difference hash) of an image. The difference hash is calculated on a 9x8 grayscale thumbnail and matches resized or re-encoded copies.
+    if filepath.endswith('.dcm'): pixels=pydicom.read_file(filepath).pixel_array
+    else: pixels=np.array(Image.open(filepath).convert('L'))
+    exact=hashlib.sha1(str((pixels.shape, pixels.dtype)).encode()+pixels.tobytes()).hexdigest()
+    plane=pixels.reshape((-1,)+pixels.shape[-2:])[0] if pixels.ndim>2 and pixels.shape[-1] not in [3, 4] else pixels
+    if plane.ndim==3: plane=plane.mean(axis=-1)
+    thumbnail=np.array(Image.fromarray(plane.astype('float32'), mode='F').resize((9, 8), Image.BILINEAR))
+    dhash=np.packbits(thumbnail[:, 1:]>thumbnail[:, :-1]).tobytes().hex()
+    return exact, dhash
+
+
+def cached_image_hashes(filepath):
+    # image_hashes cached by path, modification time and size.
+    try:
+        stat=os.stat(filepath)
+        key=(filepath, stat.st_mtime_ns, stat.st_size)
+        if key not in image_hash_cache: image_hash_cache[key]=image_hashes(filepath)
+        return image_hash_cache[key]
+    except Exception:
+        return (None, None)
+
+
+def find_leaks(tables, image_path_column='IMAGE_PATH', uid=True, pixels=False, num_workers=8, cache_file=None):
+    '''
+    Finds images shared between splits. tables is a dictionary of split name: table.
+    Checks, each in linear time using hashing: normalized file paths, SOPInstanceUID and StudyInstanceUID (uid=True, DICOM only, from table columns if present otherwise from headers)
+    and pixel content (pixels=True): exact sha1 of pixel data and perceptual difference hash. Pixel hashes are cached in memory and in cache_file if supplied.
+    Returns a table with one row per image involved in a cross-split duplicate: CHECK, KEY, SPLIT, IMAGE_PATH.
+    '''
+    long_table=pd.concat([pd.DataFrame({'SPLIT':split, 'IMAGE_PATH':table[image_path_column].to_numpy()}) for split, table in tables.items()], ignore_index=True)
+    keys={'PATH':long_table['IMAGE_PATH'].map(lambda x: os.path.normcase(os.path.abspath(str(x))))}
+    is_dicom=long_table['IMAGE_PATH'].str.endswith('.dcm')
+    if uid and is_dicom.any():
+        source=pd.concat([table for table in tables.values()], ignore_index=True)
+        if all(i in source.columns for i in ['SOPInstanceUID', 'StudyInstanceUID']):
+            headers=source[['SOPInstanceUID', 'StudyInstanceUID']]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+                headers=pd.DataFrame([h if h is not None else {} for h in executor.map(safe_read_dicom_header, long_table['IMAGE_PATH'].where(is_dicom, ''))], columns=['SOPInstanceUID', 'StudyInstanceUID'])
+        keys['SOPInstanceUID']=headers['SOPInstanceUID'].where(is_dicom.to_numpy())
+        keys['StudyInstanceUID']=headers['StudyInstanceUID'].where(is_dicom.to_numpy())
+    if pixels:
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                image_hash_cache.update(pickle.load(f))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            hashes=list(tqdm(executor.map(cached_image_hashes, long_table['IMAGE_PATH']), total=len(long_table)))
+        if cache_file:
+            with open(cache_file, 'wb') as f:
+                pickle.dump(image_hash_cache, f)
+        keys['PIXEL_SHA1']=pd.Series([h[0] for h in hashes])
+        keys['PIXEL_DHASH']=pd.Series([h[1] for h in hashes])
+    leaks=[]
+    for check, key in keys.items():
+        table=long_table.assign(CHECK=check, KEY=key.to_numpy()).dropna(subset=['KEY'])
+        num_splits=table.groupby('KEY')['SPLIT'].transform('nunique')
+        leaks.append(table[num_splits>1])
+    leaks=pd.concat(leaks, ignore_index=True)[['CHECK', 'KEY', 'SPLIT', 'IMAGE_PATH']]
+    return leaks.sort_values(['CHECK', 'KEY', 'SPLIT']).reset_index(drop=True)
 
 
 def path_to_class(filepath):
@@ -152,19 +914,87 @@ def class_to_idx(classes):
     return class_to_idx
 
 
-def datatable_from_filepath(*filelist,classes:list): #KareemElFatairy
+class Label_Matcher():
+    '''
+    Aho-Corasick automaton finding all class keywords contained in a string in one pass over its characters.
+    Matching is case insensitive substring matching, same as `keyword.casefold() in text.casefold()` for each keyword.
+    Automaton states at the end of each directory are cached, so only the file name is scanned for files in an already seen directory.
+    '''
+    def __init__(self, patterns):
+        self.patterns=list(patterns)
+        self.goto=[{}]
+        self.fail=[0]
+        self.output=[[]]
+        for idx, pattern in enumerate(self.patterns):
+            state=0
+            for char in pattern.casefold():
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char]=len(self.goto)-1
+                state=self.goto[state][char]
+            self.output[state].append(idx)
+        queue=deque(self.goto[0].values())
+        while queue:
+            state=queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state=self.fail[state]
+                while fail_state and char not in self.goto[fail_state]:
+                    fail_state=self.fail[fail_state]
+                self.fail[next_state]=self.goto[fail_state].get(char, 0) if state else 0
+                self.output[next_state]=self.output[next_state]+self.output[self.fail[next_state]]
+        self.directory_cache={}
+
+    def scan(self, text, state=0, matches=frozenset()):
+        # Continues the automaton from state over text. Returns end state and indices of all patterns found.
+        goto, fail, output=self.goto, self.fail, self.output
+        found=set(matches).union(output[0])
+        for char in text.casefold():
+            while state and char not in goto[state]:
+                state=fail[state]
+            state=goto[state].get(char, 0)
+            if output[state]: found.update(output[state])
+        return state, found
+
+    def match(self, filepath):
+        # Indices of patterns found in filepath, sorted.
+        name=os.path.basename(filepath)
+        directory=filepath[:len(filepath)-len(name)]
+        if directory not in self.directory_cache:
+            self.directory_cache[directory]=self.scan(directory)
+        state, matches=self.directory_cache[directory]
+        return sorted(self.scan(name, state, matches)[1])
+
+
+def datatable_from_filepath(*filelist, classes:list, ambiguous='keep', extensions=None, num_workers=8): #KareemElFatairy
     """ purpose: Create dataframe of file pathes and labels extracted from supplied folders.
         Argument:
         *filelist: returns list of paths.
         classes: a list of desired classes as seen in file name.
+        ambiguous: files matching more than one class are kept once per class ('keep'), excluded ('drop') or labelled with the first class in classes ('first').
+        extensions: tuple of file extensions to include. All files if None.
     """
-    file_lists = map(list_of_files,filelist)  #get a list of files from folders
+    classes=list(pd.unique(pd.Series(classes)))
+    matcher=Label_Matcher(classes)
     data={'IMAGE_PATH':[],'IMAGE_LABEL':[]}
-    for file_list in file_lists:
-      for file_path in file_list: #create lists of files with the specified label and append to the dictionary
-        for item in classes:
-          if item.casefold() in file_path.casefold():   #case insensitive match
-            data['IMAGE_PATH'].append(file_path)
-            data['IMAGE_LABEL'].append(item)
+    ambiguous_files=[]
+    for folder in filelist:
+      folder_data=[]
+      for file_path in scan_files(folder, extensions=extensions, num_workers=num_workers): #files are labelled as the directory walk streams them
+        matches=matcher.match(file_path)
+        if len(matches)>1:
+          ambiguous_files.append(file_path)
+          if ambiguous=='drop': continue
+          elif ambiguous=='first': matches=matches[:1]
+        for item in matches:
+          folder_data.append((file_path, item))
+      folder_data.sort()
+      data['IMAGE_PATH']+=[i[0] for i in folder_data]
+      data['IMAGE_LABEL']+=[classes[i[1]] for i in folder_data]
+    if len(ambiguous_files)>0:
+      log('Warning! '+str(len(ambiguous_files))+' files matched more than one class (ambiguous='+ambiguous+'), e.g. '+', '.join(ambiguous_files[:3]))
     df=pd.DataFrame(data)
+    df['IMAGE_LABEL']=pd.Categorical(df['IMAGE_LABEL'], categories=classes)
     return df
@@ -16,29 +16,173 @@
 from radtorch.settings import *
 
 
-def window_dicom(filepath, level, width):
+rescale_cache={}
+
+def rescale_parameters(ds, filepath=None):
+    # Returns (Modality, RescaleSlope, RescaleIntercept), cached per file so repeated windowing of the same file does not re-parse the header.
+    # filepath can also be a file-like object (e.g. read ahead bytes), which is not cached.
+    if not isinstance(filepath, str): filepath=None
+    if filepath is not None and filepath in rescale_cache:
+        return rescale_cache[filepath]
+    modality=ds.get('Modality', '')
+    if modality == 'CT':
+        parameters=(modality, float(ds.RescaleSlope), float(ds.RescaleIntercept))
+    else:
+        parameters=(modality, 1.0, 0.0)
+    if filepath is not None:
+        rescale_cache[filepath]=parameters
+    return parameters
+
+def downsample_array(pixels, target_size, method='mean'):
+    # Reduces a 2D (or rows x columns x channels) pixel array by the largest integer factor keeping both sides >= target_size.
+    # Works on the stored integer values, so no float conversion happens before windowing.
+    factor = min(pixels.shape[0], pixels.shape[1]) // target_size
+    if factor < 2 or pixels.ndim not in [2, 3] or (pixels.ndim == 3 and pixels.shape[2] not in [3, 4]):
+        return pixels
+    if method == 'stride':
+        return pixels[::factor, ::factor]
+    rows = (pixels.shape[0] // factor) * factor
+    columns = (pixels.shape[1] // factor) * factor
+    blocks = pixels[:rows, :columns].reshape((rows // factor, factor, columns // factor, factor) + pixels.shape[2:])
+    if pixels.dtype.kind in 'iu':
+        return (blocks.sum(axis=(1, 3), dtype='int64') // (factor * factor)).astype(pixels.dtype)
+    return blocks.mean(axis=(1, 3)).astype(pixels.dtype)
+
+def reduced_decode(ds, target_size):
+    # Decodes single frame JPEG baseline (DCT scaling) and JPEG 2000 (resolution levels) pixel data directly at a reduced size with Pillow.
+    # Returns None when the file is not eligible, in which case the full resolution pixel_array is used.
+    file_meta = getattr(ds, 'file_meta', None)
+    if file_meta is None or str(file_meta.get('TransferSyntaxUID', '')) not in REDUCED_DECODE_TRANSFER_SYNTAXES:
+        return None
+    if int(ds.get('NumberOfFrames', 1)) != 1 or ds.get('SamplesPerPixel', 1) != 1 or ds.get('PixelRepresentation', 0) != 0:
+        return None
+    factor = min(ds.Rows, ds.Columns) // target_size
+    if factor < 2:
+        return None
+    try:
+        frame = next(pydicom.encaps.generate_pixel_data_frame(ds.PixelData))
+        image = Image.open(io.BytesIO(frame))
+        if REDUCED_DECODE_TRANSFER_SYNTAXES[str(file_meta.TransferSyntaxUID)] == 'jpeg':
+            image.draft(image.mode, (ds.Columns // factor, ds.Rows // factor))
+        else:
+            image.reduce = int(math.log2(factor))
+        pixels = np.array(image)
+    except Exception:
+        return None
+    if pixels.ndim != 2 or min(pixels.shape) < target_size:
+        return None
+    return pixels
+
+def read_dicom_pixels(filepath, target_size=None, downsample='mean'):
+    # Returns (dataset, pixel array). With target_size, pixels are decoded at reduced resolution when the transfer syntax allows it,
+    # or downsampled on the stored values otherwise. The result keeps both sides >= target_size.
     ds = pydicom.read_file(filepath)
-    pixels = ds.pixel_array
-    if ds.Modality == 'CT':
-        img_hu = pixels*ds.RescaleSlope + ds.RescaleIntercept
-        lower = level - (width / 2)
-        upper = level + (width / 2)
-        img_hu[img_hu<=lower] = lower
-        img_hu[img_hu>=upper] = upper
-        return img_hu
+    if target_size:
+        pixels = reduced_decode(ds, target_size)
+        if pixels is None:
+            pixels = downsample_array(ds.pixel_array, target_size, downsample)
+    else:
+        pixels = ds.pixel_array
+    return ds, pixels
+
+@functools.lru_cache(maxsize=128)
+def window_lut(stored_dtype, slope, intercept, level, width, dtype='float32'):
+    # Lookup table mapping every possible stored value of an 8/16-bit integer image to its windowed output.
+    stored_dtype = np.dtype(stored_dtype)
+    bits = 8*stored_dtype.itemsize
+    values = np.arange(2**bits, dtype='uint'+str(bits)).view(stored_dtype)
+    lower = level - (width / 2)
+    upper = level + (width / 2)
+    lut = values.astype('float32') # same float32 steps as the window_array fallback, so both paths give identical outputs.
+    lut *= slope
+    lut += intercept
+    np.clip(lut, lower, upper, out=lut)
+    if np.dtype(dtype) == np.uint8:
+        lut -= lower
+        lut *= 255 / width
+        np.rint(lut, out=lut) # rounded, not truncated by astype.
+    lut = lut.astype(dtype)
+    lut.setflags(write=False)
+    return lut
+
+def window_array(pixels, slope, intercept, level, width, dtype='float32', out=None):
+    """
+    Applies rescale slope/intercept and window level/width to a stored pixel array.
+    8/16-bit integer pixels go through a memoized LUT gather, anything else is computed in float32.
+    """
+    if pixels.dtype.kind in 'iu' and pixels.dtype.itemsize <= 2:
+        lut = window_lut(pixels.dtype.str, float(slope), float(intercept), float(level), float(width), np.dtype(dtype).str)
+        index = pixels.view('uint'+str(8*pixels.dtype.itemsize)) # signed values index the LUT by their bit pattern.
+        return np.take(lut, index, out=out, mode='clip')
+    lower = level - (width / 2)
+    upper = level + (width / 2)
+    img_hu = pixels.astype('float32')
+    img_hu *= slope
+    img_hu += intercept
+    np.clip(img_hu, lower, upper, out=img_hu)
+    if np.dtype(dtype) == np.uint8:
+        img_hu -= lower
+        img_hu *= 255 / width
+        np.rint(img_hu, out=img_hu)
+    if out is None:
+        return img_hu.astype(dtype, copy=False)
+    np.copyto(out, img_hu, casting='unsafe')
+    return out
+
+def window_dicom(filepath, level, width, dtype='float32', target_size=None):
+    ds, pixels = read_dicom_pixels(filepath, target_size)
+    modality, slope, intercept = rescale_parameters(ds, filepath)
+    if modality == 'CT':
+        return window_array(pixels, slope, intercept, level, width, dtype)
     else:
         return (pixels)
 
-def dicom_to_narray(filepath, mode='RAW', wl=None):
+def multi_window_dicom(filepath, wl, dtype='float32', target_size=None):
+    """
+    Decodes the file once and returns an array of shape (rows, columns, len(wl)) with one window per channel.
+    wl: list of (level, width). dtype: 'float32' and 'int16' return clipped HU values, 'uint8' scales each window to 0-255.
+    Non CT images are not windowed, with dtype 'uint8' their pixel range is scaled to 0-255.
+    """
+    ds, pixels = read_dicom_pixels(filepath, target_size)
+    modality, slope, intercept = rescale_parameters(ds, filepath)
+    output = np.empty(pixels.shape+(len(wl),), dtype=dtype)
+    if modality != 'CT': # same as window_dicom, non CT images are not windowed.
+        if output.dtype == np.uint8:
+            lower, upper = float(pixels.min()), float(pixels.max())
+            pixels = np.rint((pixels.astype('float32') - lower) * (255 / max(upper - lower, 1.0)))
+        np.copyto(output, pixels[..., np.newaxis], casting='unsafe')
+        return output
+    if pixels.dtype.kind in 'iu' and pixels.dtype.itemsize <= 2:
+        for i, (level, width) in enumerate(wl):
+            window_array(pixels, slope, intercept, level, width, dtype, out=output[..., i])
+        return output
+    level = np.array([i[0] for i in wl], dtype='float32')
+    width = np.array([i[1] for i in wl], dtype='float32')
+    lower = level - (width / 2)
+    upper = level + (width / 2)
+    img_hu = pixels.astype('float32')
+    if slope != 1: img_hu *= slope
+    if intercept != 0: img_hu += intercept
+    if output.dtype == np.float32:
+        np.clip(img_hu[..., np.newaxis], lower, upper, out=output)
+    else:
+        windows = np.clip(img_hu[..., np.newaxis], lower, upper)
+        if output.dtype == np.uint8:
+            windows -= lower
+            windows *= 255 / width
+            np.rint(windows, out=windows)
+        np.copyto(output, windows, casting='unsafe')
+    return output
+
+def dicom_to_narray(filepath, mode='RAW', wl=None, target_size=None):
     if mode == 'RAW':
-        ds = pydicom.read_file(filepath)
-        img = ds.pixel_array
+        ds, img = read_dicom_pixels(filepath, target_size)
         return img
     elif mode == 'HU':
-        ds = pydicom.read_file(filepath)
-        pixels = ds.pixel_array
-        if ds.Modality == 'CT':
-            hu_img = pixels*ds.RescaleSlope + ds.RescaleIntercept
+        ds, pixels = read_dicom_pixels(filepath, target_size)
+        modality, slope, intercept = rescale_parameters(ds, filepath)
+        if modality == 'CT':
+            hu_img = pixels*slope + intercept
         else:
             hu_img = pixels
         return hu_img
@@ -48,20 +192,71 @@ def dicom_to_narray(filepath, mode='RAW', wl=None):
         elif len(wl) != 1:
             print ('Error! argument "wl" can only accept 1 combination of W and L when "WIN" mode is selected')
         else:
-            win_img = window_dicom(filepath, wl[0][0], wl[0][1])
+            win_img = window_dicom(filepath, wl[0][0], wl[0][1], target_size=target_size)
             return win_img
     elif mode == 'MWIN':
         if wl==None:
             print ('Error! argument "wl" cannot be empty when "MWIN" mode is selected')
-        elif len(wl)!=3:
-            print ('Error! argument "wl" must contain 3 combinations of W and L when "MWIN" mode is selected')
+        elif len(wl)<2:
+            print ('Error! argument "wl" must contain at least 2 combinations of W and L when "MWIN" mode is selected')
         else:
-            img0 = window_dicom(filepath, wl[0][0], wl[0][1]).astype('int16')
-            img1 = window_dicom(filepath, wl[1][0], wl[1][1]).astype('int16')
-            img2 = window_dicom(filepath, wl[2][0], wl[2][1]).astype('int16')
-            mwin_img = np.stack((img0,img1,img2), axis=-1)
+            mwin_img = multi_window_dicom(filepath, wl, dtype='uint8', target_size=target_size) # uint8 windows, one per channel, as Image.fromarray takes them.
             return mwin_img
 
+def read_dicom_header(filepath):
+    # Reads header elements listed in DICOM_CATALOG_TAGS without loading pixel data.
+    ds = pydicom.read_file(filepath, stop_before_pixels=True)
+    header = {}
+    for tag, tag_type in DICOM_CATALOG_TAGS.items():
+        value = ds.get(tag, None)
+        if tag_type == 'str':
+            header[tag] = None if value is None else str(value)
+        elif tag_type == 'int':
+            header[tag] = 1 if value is None and tag == 'NumberOfFrames' else (None if value is None else int(value))
+        else:
+            header[tag] = None if value is None else float(value)
+    file_meta = getattr(ds, 'file_meta', None)
+    header['TransferSyntaxUID'] = str(file_meta.TransferSyntaxUID) if file_meta is not None and 'TransferSyntaxUID' in file_meta else None
+    return header
+
+def slice_position(filepath):
+    # Position of a slice along the normal of its image plane (ImagePositionPatient . row x column direction). Falls back to z position, then InstanceNumber.
+    ds = pydicom.read_file(filepath, stop_before_pixels=True)
+    if 'ImagePositionPatient' not in ds:
+        return float(ds.get('InstanceNumber', 0))
+    position = np.array(ds.ImagePositionPatient, dtype='float64')
+    if 'ImageOrientationPatient' in ds:
+        orientation = np.array(ds.ImageOrientationPatient, dtype='float64')
+        return float(np.dot(position, np.cross(orientation[:3], orientation[3:])))
+    return float(position[2])
+
+def dicom_series_to_volume(files, output_path, num_workers=8):
+    """
+    Assembles the slices of a DICOM series into one int16 volume (slices, rows, columns) sorted by slice position and saved as .npy at output_path.
+    CT values are stored as HU. Returns the volume opened as a read-only memory map. If output_path exists, it is reused without reading the series.
+    """
+    if os.path.exists(output_path):
+        return np.load(output_path, mmap_mode='r')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        positions = list(executor.map(slice_position, files))
+    sorted_files = [files[i] for i in np.argsort(positions, kind='stable')]
+    temp_path = output_path+'.tmp.npy'
+    first_ds, first_pixels = read_dicom_pixels(sorted_files[0])
+    volume = np.lib.format.open_memmap(temp_path, mode='w+', dtype='int16', shape=(len(sorted_files),)+first_pixels.shape)
+
+    def write_slice(i):
+        ds, pixels = read_dicom_pixels(sorted_files[i])
+        modality, slope, intercept = rescale_parameters(ds, sorted_files[i])
+        if modality == 'CT': pixels = pixels*slope + intercept
+        np.clip(pixels, -32768, 32767, out=volume[i], casting='unsafe')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(write_slice, range(len(sorted_files))))
+    volume.flush()
+    del volume
+    os.replace(temp_path, output_path)
+    return np.load(output_path, mmap_mode='r')
+
 def dicom_to_pil(filepath):
 
     """
@@ -90,65 +285,69 @@ def find_coordinates(vol="inputvol",roi="croproi"):
     print (coordinates)
 
 # Split Multiphasic study
-def split_multiphasic_scan(input_dir, output_dir, modality=''):
+def read_phase_header(filepath, modality):
+    # Header-only read of the elements used to assign phases.
+    try:
+        ds = pydicom.read_file(filepath, force=True, stop_before_pixels=True)
+        if modality=='MRI': return {'ImagePositionPatient':float(ds.ImagePositionPatient[2]), 'InstanceNumber':int(ds.InstanceNumber)}
+        else: return {'slice_location':float(ds.SliceLocation), 'aq_time':str(ds.AcquisitionTime)}
+    except Exception:
+        return None
+
+
+def write_phase(input_path, output_path, phase):
+    # Rewrites one file with phase suffixed series identifiers. Pixel data is deferred and copied as stored, without decoding.
+    # Files are written to a temporary name and renamed, so an interrupted run never leaves a partial output.
+    if os.path.exists(output_path): return False
+    ds = pydicom.read_file(input_path, defer_size='1 KB')
+    ds.SeriesDescription = ds.get('SeriesDescription', '')+'_phase_'+str(phase)
+    ds.SeriesInstanceUID = ds.SeriesInstanceUID+str(phase)
+    ds.SeriesNumber = str(ds.get('SeriesNumber', ''))+str(phase)
+    temp_path = output_path+'.tmp'
+    ds.save_as(temp_path)
+    os.replace(temp_path, output_path)
+    return True
+
+
+def split_multiphasic_scan(input_dir, output_dir, modality='', num_workers=8):
+    '''
+    Splits a multiphasic MRI (phases by repeated ImagePositionPatient, ordered by InstanceNumber) or CT (phases by AcquisitionTime) scan into one series per phase.
+    Headers are read without pixel data in parallel, files are rewritten on a process pool. Files already present in output_dir are skipped, so an interrupted run can be resumed.
+    Returns the phase plan table.
+    '''
+    if modality not in ['MRI', 'CT']:
+        print ('Error. Modality should be MRI or CT.')
+        return
+    print ('Creating file list.')
+    files = [os.path.join(r, i) for r, d, f in os.walk(input_dir) for i in f if not i.endswith('.tmp')]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        headers = list(tqdm(executor.map(functools.partial(read_phase_header, modality=modality), files), total=len(files)))
+    failed = [f for f, h in zip(files, headers) if h is None]
+    if len(failed)>0:
+        print ('Warning.', len(failed), 'files could not be read and were skipped.')
+    df = pd.DataFrame([h for h in headers if h is not None])
+    df.insert(0, 'ImageId', [os.path.basename(f) for f, h in zip(files, headers) if h is not None])
+    df.insert(0, 'ImagePath', [f for f, h in zip(files, headers) if h is not None])
+
+    print ('Calculating number of phases.')
     if modality=='MRI':
-        files = []
-        position = []
-        instance = []
-        print ('Creating file list.')
-        for r, d, f in os.walk(input_dir):
-            for i in f:
-                i_path = os.path.join(r,i)
-                files.append(i)
-                ds = pydicom.read_file(i_path, force=True)
-                position.append(ds.ImagePositionPatient[2])
-                instance.append(ds.InstanceNumber)
-        df = pd.DataFrame({'ImageId':files, 'ImagePositionPatient':position, 'InstanceNumber':instance})
-        number_phases = len(files) / len(df['ImagePositionPatient'].unique())
-        print ('Calculating number of phases.')
+        number_phases = len(df) / df['ImagePositionPatient'].nunique()
         if number_phases.is_integer():
             number_phases = int(number_phases)
         else:
             print ('Error. Number of images can not be split across the calculated number of phases')
             return
-        phases = []
-        for i in range(0,number_phases):
-            phases.append('phase_'+str(i))
-        phases_list = phases * len(df['ImagePositionPatient'].unique())
-        df = df.sort_values(by=['ImagePositionPatient', 'InstanceNumber']);
-        df['phase'] = phases_list
-        print ('Splitting into',number_phases,'phases.')
-        for i, r in tqdm(df.iterrows(), total=len(df)):
-            img_path = input_dir+r['ImageId']
-            ds = pydicom.read_file(img_path)
-            ds.SeriesDescription = ds.SeriesDescription+'_'+r['phase']
-            ds.SeriesInstanceUID = ds.SeriesInstanceUID+r['phase'][-1]
-            ds.SeriesNumber =  str(ds.SeriesNumber)+r['phase'][-1]
-            ds.save_as(output_dir+r['ImageId'])
-        print ('Splitting completed successfully')
-
-    elif modality=='CT':
-        files = []
-        slice_location = []
-        aq_time = []
-        print ('Creating file list.')
-        for r,ds, fs in os.walk(input_dir):
-            for f in fs:
-                img_path = input_dir+f
-                dicom_data = pydicom.read_file(img_path)
-                files.append(f)
-                slice_location.append(dicom_data.SliceLocation)
-                aq_time.append(dicom_data.AcquisitionTime)
-        dataframe = pd.DataFrame({'img_id':files, 'slice_location':slice_location, 'aq_time':aq_time})
-        dataframe.sort_values(by=['aq_time', 'slice_location'])
-        print ('Calculating number of phases.')
-        unique_aq_time = dataframe.aq_time.unique().tolist()
-        print ('Splitting into',len(unique_aq_time),'phases.')
-        for i, r in tqdm(dataframe.iterrows(), total=len(dataframe)):
-            img_path = input_dir+r['img_id']
-            ds = pydicom.read_file(img_path)
-            ds.SeriesDescription = ds.SeriesDescription+'_'+ str(unique_aq_time.index(r['aq_time']))
-            ds.SeriesInstanceUID = ds.SeriesInstanceUID+ str(unique_aq_time.index(r['aq_time']))
-            ds.SeriesNumber =  str(ds.SeriesNumber)+str(unique_aq_time.index(r['aq_time']))
-            ds.save_as(output_dir+r['img_id'])
-        print ('Splitting completed successfully')
+        df = df.sort_values(by=['ImagePositionPatient', 'InstanceNumber'])
+        df['phase'] = df.groupby('ImagePositionPatient').cumcount()
+    else:
+        df = df.sort_values(by=['aq_time', 'slice_location'])
+        df['phase'] = pd.factorize(df['aq_time'], sort=True)[0]
+        number_phases = df['phase'].nunique()
+
+    print ('Splitting into',number_phases,'phases.')
+    os.makedirs(output_dir, exist_ok=True)
+    output_paths = [os.path.join(output_dir, i) for i in df['ImageId']]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        written = list(tqdm(executor.map(write_phase, df['ImagePath'], output_paths, df['phase'], chunksize=64), total=len(df)))
+    print ('Splitting completed successfully.', sum(written), 'files written,', len(written)-sum(written), 'existing files skipped.')
+    return df
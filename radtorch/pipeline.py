@@ -51,10 +51,7 @@ class Image_Classification():
 
         if 'device' not in kwargs.keys(): self.device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
         if 'data_processor' not in self.__dict__.keys(): self.data_processor=Data_Processor(**self.__dict__)
-        if 'feature_extractor' not in self.__dict__.keys(): self.feature_extractor=Feature_Extractor(dataloader=self.data_processor.master_dataloader, **self.__dict__)
-        if 'extracted_feature_dictionary' not in self.__dict__.keys():
-            self.train_feature_extractor=Feature_Extractor(dataloader=self.data_processor.train_dataloader, **self.__dict__)
-            self.test_feature_extractor=Feature_Extractor(dataloader=self.data_processor.test_dataloader, **self.__dict__)
+        # One Feature_Extractor (one backbone) is shared by feature extraction, NN_Classifier and prediction. It is created when the pipeline runs.
 
 
     def info(self):
@@ -65,21 +62,9 @@ class Image_Classification():
     def run(self, **kw):
         log('Starting Image Classification Pipeline')
         set_random_seed(100)
+        if 'feature_extractor' not in self.__dict__.keys(): self.feature_extractor=Feature_Extractor(**self.__dict__)
         if self.type!='nn_classifier':
-            log('Phase 1: Feature Extraction.')
-
-            if 'extracted_feature_dictionary' in self.__dict__.keys():
-                log('Features Already Extracted. Loading Previously Extracted Features')
-            else:
-                log('Extracting Training Features')
-                self.train_feature_extractor.run()
-                log('Extracting Testing Features')
-                self.test_feature_extractor.run()
-                self.extracted_feature_dictionary={
-                                                    'train':{'features':self.train_feature_extractor.features, 'labels':self.train_feature_extractor.labels_idx, 'features_names': self.train_feature_extractor.feature_names,},
-                                                    'test':{'features':self.test_feature_extractor.features, 'labels':self.test_feature_extractor.labels_idx, 'features_names': self.test_feature_extractor.feature_names,}
-                                                    }
-
+            self.extract_features()
             log('Phase 2: Classifier Training.')
             log ('Running Classifier Training.')
             self.classifier=Classifier(**self.__dict__)
@@ -93,6 +78,18 @@ class Image_Classification():
             self.trained_model, self.train_metrics=self.classifier.run()
             log ('Classifier Training completed successfully.')
 
+    def extract_features(self):
+        log('Phase 1: Feature Extraction.')
+        if 'feature_extractor' not in self.__dict__.keys(): self.feature_extractor=Feature_Extractor(**self.__dict__)
+        if 'extracted_feature_dictionary' in self.__dict__.keys():
+            log('Features Already Extracted. Loading Previously Extracted Features')
+        else:
+            log('Extracting Training and Testing Features')
+            self.feature_extractor.dataloader=self.data_processor.split_dataloader(['train', 'test'])
+            self.feature_extractor.run()
+            self.extracted_feature_dictionary={split:self.feature_extractor.split_features(split) for split in ['train', 'test']}
+        return self.extracted_feature_dictionary
+
     def metrics(self, figure_size=(500,300)):
         return show_metrics([self.classifier],  fig_size=figure_size)
 
@@ -107,6 +104,110 @@ class Image_Classification():
             pass
 
 
+def init_scenario_worker(threads_per_process):
+    # Thread caps of a scenario worker process: BLAS/OpenMP pools, torch intra-op threads.
+    for k in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']: os.environ[k]=str(threads_per_process)
+    threadpool_limits(threads_per_process)
+    torch.set_num_threads(threads_per_process)
+
+
+def share_features(features, shared_blocks):
+    # Copies a feature DataFrame into shared memory once (keyed by object id) and returns its descriptor.
+    if id(features) not in shared_blocks:
+        array=np.ascontiguousarray(features.to_numpy())
+        block=shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:]=array
+        shared_blocks[id(features)]=(block, {'name':block.name, 'shape':array.shape, 'dtype':array.dtype.str, 'columns':features.columns, 'index':features.index})
+    return shared_blocks[id(features)][1]
+
+
+def train_scenario_classifier(state, features):
+    # Runs in a worker process: trains a Classifier from its picklable state and shared memory features.
+    classifier=Classifier.__new__(Classifier)
+    classifier.__dict__.update(state)
+    blocks=[]
+    for k, descriptor in features.items():
+        block=shared_memory.SharedMemory(name=descriptor['name'])
+        blocks.append(block)
+        array=np.ndarray(descriptor['shape'], dtype=descriptor['dtype'], buffer=block.buf)
+        setattr(classifier, k, pd.DataFrame(array, columns=descriptor['columns'], index=descriptor['index'], copy=False))
+    set_random_seed(100)
+    classifier.run()
+    result=pickle.loads(pickle.dumps({k:classifier.__dict__[k] for k in ['classifier', 'scores', 'train_metrics', 'classes']}))
+    del classifier, array
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError: # fitted estimator still holds a view of the features (e.g. knn), released with the worker's copy.
+            pass
+    return result
+
+
+class Scenario_Pool():
+    # Process pool for Compare_Image_Classifiers classifier stages. Results are yielded as they finish, a failed scenario returns its exception.
+    # If a worker crashes, the pool is restarted once and unfinished scenarios are resubmitted.
+    def __init__(self, num_processes, threads_per_process=1, restarts=1):
+        self.num_processes=num_processes
+        self.threads_per_process=threads_per_process
+        self.restarts=restarts
+        self.jobs={}
+        self.futures={}
+        self.done=set()
+        self.start()
+
+    def start(self):
+        log('Starting scenario process pool: '+str(self.num_processes)+' processes, '+str(self.threads_per_process)+' threads per process.')
+        self.executor=concurrent.futures.ProcessPoolExecutor(max_workers=self.num_processes, initializer=init_scenario_worker, initargs=(self.threads_per_process,))
+
+    def submit(self, i, classifier, shared_blocks):
+        state={k:getattr(classifier, k) for k in ['type', 'classifier_type', 'classifier', 'cv', 'stratified', 'num_splits', 'train_labels', 'test_labels']}
+        features={k:share_features(getattr(classifier, k), shared_blocks) for k in ['train_features', 'test_features']}
+        self.jobs[i]=(state, features)
+        try:
+            self.futures[self.executor.submit(train_scenario_classifier, state, features)]=i
+        except concurrent.futures.process.BrokenProcessPool:
+            pass # resubmitted by results() after the pool restarts.
+
+    def collect(self, future):
+        # (scenario, result or exception) of a finished future. None if the pool crashed, the scenario is then resubmitted by results().
+        i=self.futures.pop(future)
+        try:
+            result=future.result()
+        except concurrent.futures.process.BrokenProcessPool:
+            return None
+        except Exception as e:
+            result=e
+        self.done.add(i)
+        return i, result
+
+    def finished(self): # results of scenarios finished so far, without waiting.
+        for future in [future for future in self.futures if future.done()]:
+            result=self.collect(future)
+            if result is not None: yield result
+
+    def results(self): # results of all remaining scenarios as they finish.
+        while True:
+            for future in concurrent.futures.as_completed(list(self.futures)):
+                result=self.collect(future)
+                if result is not None: yield result
+            remaining=[i for i in self.jobs if i not in self.done]
+            if len(remaining)==0: return
+            if self.restarts==0:
+                for i in remaining:
+                    self.done.add(i)
+                    yield i, concurrent.futures.process.BrokenProcessPool('Scenario process pool crashed.')
+                return
+            log('Warning! Scenario process pool crashed. Restarting pool for '+str(len(remaining))+' unfinished scenarios.')
+            self.restarts-=1
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.start()
+            for i in remaining:
+                self.futures[self.executor.submit(train_scenario_classifier, *self.jobs[i])]=i
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
 # NEEDS TESTING
 class Compare_Image_Classifiers():
 
@@ -146,27 +247,127 @@ class Compare_Image_Classifiers():
                     summary_columns.append(col)
             return self.scenarios_df[summary_columns]
 
-    def run(self):
-
+    def stage_keys(self, scenario, input_size=True):
+        # (data stage key, feature stage key) of a scenario. Data splits differ for nn_classifier, so it is part of both keys.
+        # Data_Processor resizes to custom_resize, else to the input size of model_arch, so the effective input size is part of the data key (input_size=False leaves it out).
+        def key(exclude, extra=[]):
+            items=[(k, ('DataFrame', id(v)) if isinstance(v, pd.DataFrame) else repr(v)) for k, v in scenario.items() if k not in exclude]
+            return repr(sorted(items)+[('nn_classifier', scenario['type']=='nn_classifier')]+extra)
+        size=scenario['custom_resize'] if scenario['custom_resize'] not in [False, '', 0, None] else model_dict[scenario['model_arch']]['input_size']
+        return key(CLASSIFIER_STAGE_PARAMETERS+FEATURE_STAGE_PARAMETERS, [('input_size', size)] if input_size else []), key(CLASSIFIER_STAGE_PARAMETERS)
+
+    def plan(self):
+        # Scenarios grouped by shared stages: one Data_Processor per DATA_STAGE and one feature extraction per FEATURE_STAGE.
+        keys=[self.stage_keys(x) for x in self.scenarios_list]
+        plan=pd.DataFrame({'SCENARIO':range(len(keys)), 'TYPE':[x['type'] for x in self.scenarios_list],
+                            'DATA_STAGE':pd.factorize([k[0] for k in keys])[0], 'FEATURE_STAGE':pd.factorize([k[1] for k in keys])[0]})
+        log('Comparison plan: '+str(len(plan))+' scenarios, '+str(plan['DATA_STAGE'].nunique())+' data processing stages, '+str(plan['FEATURE_STAGE'].nunique())+' feature extraction stages.')
+        return plan
+
+    def run(self, num_processes=1, threads_per_process=1, multi_backbone=False):
+        # num_processes>1 (None = all cores) trains sklearn classifiers in a process pool while the main process extracts features and trains nn_classifier scenarios.
+        # multi_backbone: feature stages differing only in model_arch are extracted together in one pass over the images, see Multi_Feature_Extractor.
         log('Starting Image Classification Model Comparison Pipeline.')
-        self.master_metrics=[]
-        self.trained_models=[]
-
-        for x in self.scenarios_list:
-            classifier=Image_Classification(**x)
-            log('Starting Training Classifier Number '+str(self.scenarios_list.index(x)))
-            classifier.run()
-            self.classifiers.append(classifier)
-            self.trained_models.append(classifier.trained_model)
-            self.master_metrics.append(classifier.train_metrics)
-            torch.cuda.empty_cache()
-            print('')
+        if num_processes is None: num_processes=max(1, (os.cpu_count() or 1)//threads_per_process)
+        self.classifiers=[None]*self.num_scenarios
+        self.trained_models=[None]*self.num_scenarios
+        self.master_metrics=[None]*self.num_scenarios
+        keys=[self.stage_keys(x) for x in self.scenarios_list]
+        self.plan()
+        data_stages={}
+        feature_stages={}
+        jobs={}
+        shared_blocks={}
+        pool=Scenario_Pool(num_processes, threads_per_process) if num_processes>1 else None
+        if multi_backbone: self.extract_multi_backbone(keys, feature_stages)
+        try:
+            for i, (x, (data_key, feature_key)) in enumerate(zip(self.scenarios_list, keys)):
+                x=dict(x)
+                if data_key in data_stages: x['data_processor']=data_stages[data_key]
+                if feature_key in feature_stages: x.update(feature_stages[feature_key])
+                if pool and 'n_jobs' not in x: x['n_jobs']=threads_per_process
+                log('Starting Training Classifier Number '+str(i))
+                try:
+                    classifier=Image_Classification(**x)
+                    if pool and classifier.type!='nn_classifier':
+                        set_random_seed(100)
+                        classifier.extract_features()
+                        classifier.classifier=Classifier(**classifier.__dict__)
+                        jobs[i]=classifier
+                        pool.submit(i, classifier.classifier, shared_blocks)
+                    else:
+                        classifier.run()
+                        self.add_result(i, classifier)
+                except Exception as e:
+                    log('Error! Classifier Number '+str(i)+' failed: '+repr(e))
+                    continue
+                finally:
+                    torch.cuda.empty_cache()
+                    if pool:
+                        for j, result in pool.finished(): self.pool_result(j, result, jobs)
+                data_stages[data_key]=classifier.data_processor
+                feature_stages[feature_key]={'feature_extractor':classifier.feature_extractor}
+                if 'extracted_feature_dictionary' in classifier.__dict__.keys(): feature_stages[feature_key]['extracted_feature_dictionary']=classifier.extracted_feature_dictionary
+                print('')
+            if pool:
+                for i, result in pool.results(): self.pool_result(i, result, jobs)
+        finally:
+            if pool: pool.shutdown()
+            for block, descriptor in shared_blocks.values():
+                block.close()
+                block.unlink()
+        log('Comparison finished: '+str(sum(x is not None for x in self.classifiers))+' of '+str(self.num_scenarios)+' classifiers trained successfully.')
+
+    def multi_backbone_groups(self, keys):
+        # Feature stages of non nn_classifier scenarios differing only in model_arch (and so possibly input size): {feature stage key: first scenario} per group.
+        groups={}
+        for x, (data_key, feature_key) in zip(self.scenarios_list, keys):
+            if x['type']=='nn_classifier' or 'extracted_feature_dictionary' in x.keys(): continue
+            groups.setdefault((self.stage_keys(x, input_size=False)[0], repr(x['pre_trained']), repr(x['unfreeze'])), {}).setdefault(feature_key, x)
+        return [i for i in groups.values() if len(i)>1]
+
+    def extract_multi_backbone(self, keys, feature_stages):
+        for group in self.multi_backbone_groups(keys):
+            scenarios=list(group.values())
+            log('Extracting features of '+', '.join([i['model_arch'] for i in scenarios])+' in one pass.')
+            try:
+                feature_extractors=[]
+                for x in scenarios:
+                    set_random_seed(100)
+                    feature_extractors.append(Feature_Extractor(**x))
+                x=dict(scenarios[0])
+                if x['custom_resize'] in [False, '', 0, None]: x['custom_resize']=max(model_dict[i['model_arch']]['input_size'] for i in scenarios)
+                data_processor=Data_Processor(**x)
+                multi_feature_extractor=Multi_Feature_Extractor(feature_extractors=feature_extractors, dataloader=data_processor.split_dataloader(['train', 'test']), custom_resize=scenarios[0]['custom_resize'], device=self.device)
+                multi_feature_extractor.run()
+            except Exception as e:
+                log('Error! Multi backbone feature extraction failed, features will be extracted per scenario: '+repr(e))
+                continue
+            for feature_key, feature_extractor in zip(group.keys(), feature_extractors):
+                feature_stages[feature_key]={'feature_extractor':feature_extractor, 'extracted_feature_dictionary':{split:feature_extractor.split_features(split) for split in ['train', 'test']}}
+
+    def pool_result(self, i, result, jobs):
+        if isinstance(result, Exception):
+            log('Error! Classifier Number '+str(i)+' failed: '+repr(result))
+        else:
+            jobs[i].classifier.__dict__.update(result)
+            self.add_result(i, jobs[i])
+            log('Classifier Number '+str(i)+' finished. Accuracy: %0.2f' % (result['scores'].mean()))
+
+    def add_result(self, i, classifier):
+        if classifier.type!='nn_classifier':
+            classifier.trained_model=classifier.classifier
+            classifier.train_metrics=classifier.classifier.train_metrics
+        self.classifiers[i]=classifier
+        self.trained_models[i]=classifier.trained_model
+        self.master_metrics[i]=classifier.train_metrics
 
     def roc(self, figure_size=(700,400)):
-        self.auc_list=show_roc([i.classifier for i in self.classifiers], fig_size=figure_size)
+        trained=[i for i in self.classifiers if i is not None]
+        self.auc_list=show_roc([i.classifier for i in trained], fig_size=figure_size)
         self.best_model_auc=max(self.auc_list)
-        self.best_model_index=(self.auc_list.index(self.best_model_auc))
-        self.best_classifier=self.classifiers[self.best_model_index]
+        self.best_classifier=trained[self.auc_list.index(self.best_model_auc)]
+        self.best_model_index=self.classifiers.index(self.best_classifier)
 
     def best(self, export=False):
         try:
@@ -13,12 +13,13 @@
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-import torch, torchvision, datetime, time, pickle, pydicom, os, math, random, itertools, ntpath, copy
+import torch, torchvision, datetime, time, pickle, pydicom, os, math, random, itertools, ntpath, copy, hashlib, functools, concurrent.futures, statistics, io, multiprocessing, json, bisect
 import torchvision.models as models
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 import torchvision.datasets as datasets
+from torch.fx.experimental.optimization import fuse as fuse_conv_bn
 
 import numpy as np
 import pandas as pd
@@ -45,7 +46,9 @@ from torch.utils.data.dataset import Dataset
 from torchvision import transforms
 from PIL import Image
 from pathlib import Path
-from collections import Counter
+from collections import Counter, deque
+from multiprocessing import shared_memory
+from threadpoolctl import threadpool_limits
 from IPython.display import display
 from bokeh.io import output_notebook, show
 from math import pi
@@ -98,6 +101,16 @@ model_dict={
 
 supported_models=[x for x in model_dict.keys()]
 
+# Feature_Extractor inference modes (kwarg inference). Except fp32, modes run under torch.inference_mode on a copy of the model,
+# fuse folds BatchNorm into the preceding convolution, bf16 runs the model under bfloat16 autocast.
+INFERENCE_MODES={
+'fp32':{'channels_last':False, 'fuse':False, 'bf16':False},
+'channels_last':{'channels_last':True, 'fuse':False, 'bf16':False},
+'fused':{'channels_last':True, 'fuse':True, 'bf16':False},
+'bf16':{'channels_last':True, 'fuse':False, 'bf16':True},
+'bf16_fused':{'channels_last':True, 'fuse':True, 'bf16':True},
+}
+
 supported_multi_label_image_classification_losses=[]
 
 supported_nn_optimizers=[
@@ -131,6 +144,7 @@ CLASSIFER_DEFAULT_SETTINGS={
 'image_label_col':'IMAGE_LABEL',
 'interaction_terms':False,
 'parameters':{},
+'n_jobs':-1,
 }
 
 
@@ -173,6 +187,7 @@ DEFAULT_DATASET_SETTINGS={
 'table':None,
 'normalize':((0, 0, 0), (1, 1, 1)),
 'balance_class':False,
+'balance_epoch_size':None,
 'image_path_column':'IMAGE_PATH',
 'image_label_column':'IMAGE_LABEL',
 'type':'logistic_regression',
@@ -183,7 +198,13 @@ DEFAULT_DATASET_SETTINGS={
 'custom_resize':False,
 'multi_label':False,
 'num_workers':0,
-
+'pixel_cache':False,
+'pixel_cache_size':10*1024**3,
+'catalog':None,
+'deferred_normalize':False,
+'decode_size':None,
+'read_ahead':False,
+'read_ahead_threads':8,
 }
 
 ################################################################################################################################################
@@ -200,6 +221,24 @@ IMG_EXTENSIONS=(
 '.tiff',
 '.webp')
 
+REDUCED_DECODE_TRANSFER_SYNTAXES={
+'1.2.840.10008.1.2.4.50':'jpeg',
+'1.2.840.10008.1.2.4.90':'jpeg2000',
+'1.2.840.10008.1.2.4.91':'jpeg2000',
+}
+
+DICOM_CATALOG_TAGS={
+'Modality':'str',
+'Rows':'int',
+'Columns':'int',
+'RescaleSlope':'float',
+'RescaleIntercept':'float',
+'StudyInstanceUID':'str',
+'SeriesInstanceUID':'str',
+'SOPInstanceUID':'str',
+'NumberOfFrames':'int',
+}
+
 ################################################################################################################################################
 
 #pipeline
@@ -225,6 +264,13 @@ IMAGE_CLASSIFICATION_PIPELINE_SETTINGS={
 }
 
 
+# Compare_Image_Classifiers stages: scenarios differing only in classifier stage parameters share the data processor and extracted features,
+# scenarios also differing in feature stage parameters share the data processor only.
+FEATURE_STAGE_PARAMETERS=['model_arch', 'pre_trained', 'unfreeze']
+CLASSIFIER_STAGE_PARAMETERS=['type', 'parameters', 'cv', 'stratified', 'num_splits', 'label_column', 'interaction_terms', 'custom_nn_classifier',
+'learning_rate', 'epochs', 'optimizer', 'loss_function', 'optimizer_parameters', 'lr_scheduler', 'output_features']
+
+
 FEATURE_EXTRACTION_PIPELINE_SETTINGS={
 'table':None,
 'is_dicom':True,
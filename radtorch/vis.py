@@ -169,8 +169,10 @@ def show_nn_confusion_matrix(model, target_data_set, target_classes, device, fig
 
     model.to(device)
     target_data_loader = torch.utils.data.DataLoader(target_data_set,batch_size=16,shuffle=False)
+    batch_transform = getattr(target_data_set, 'batch_transform', None)
 
     for i, (imgs, labels, paths) in tqdm(enumerate(target_data_loader), total=len(target_data_loader)):
+        if batch_transform is not None: imgs = batch_transform(imgs)
         imgs = imgs.to(device)
         labels = labels.to(device)
         true_labels = true_labels+labels.tolist()
@@ -202,8 +204,10 @@ def show_nn_misclassified(model, target_data_set, num_of_images, device, transfo
 
     model.to(device)
     target_data_loader = torch.utils.data.DataLoader(target_data_set,batch_size=16,shuffle=False)
+    batch_transform = getattr(target_data_set, 'batch_transform', None)
 
     for i, (imgs, labels, paths) in tqdm(enumerate(target_data_loader), total=len(target_data_loader)):
+        if batch_transform is not None: imgs = batch_transform(imgs)
         imgs = imgs.to(device)
         labels = labels.to(device)
         true_labels = true_labels+labels.tolist()
@@ -470,8 +474,10 @@ def calculate_nn_predictions(model, target_data_set,  device):
     pred_labels = []
     model.to(device)
     target_data_loader = torch.utils.data.DataLoader(target_data_set,batch_size=16,shuffle=False)
+    batch_transform = getattr(target_data_set, 'batch_transform', None)
 
     for i, (imgs, labels, path) in tqdm(enumerate(target_data_loader), total=len(target_data_loader)):
+        if batch_transform is not None: imgs = batch_transform(imgs)
         imgs = imgs.to(device)
         labels = labels.to(device)
         true_labels = true_labels+labels.tolist()